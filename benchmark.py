@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# benchmark.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from configparser import ConfigParser
+from typing import Dict, List
+
+from libingest import PasscodeBridge
+from libsqlite import CodeStorage, MemoryCodeStorage
+from localserver import OutboundQueue, WebServer, WsCoroutine, encode_response
+
+
+class FakeWebSocket:
+    ws_protocol = None
+
+    def __init__(self, on_code):
+        self.on_code = on_code
+
+    async def send_str(self, payload: str) -> None:
+        data = json.loads(payload)
+        if data['status'] == 200:
+            self.on_code(data['body'])
+
+    async def close(self, **_kwargs) -> None:
+        pass
+
+
+class SlowWebSocket(FakeWebSocket):
+    """Client on a bad connection, every frame takes `delay` seconds to write"""
+
+    def __init__(self, delay: float):
+        super().__init__(lambda _code: None)
+        self.delay = delay
+
+    async def send_str(self, payload: str) -> None:
+        await asyncio.sleep(self.delay)
+
+
+class PollingWsCoroutine(WsCoroutine):
+    """Reproduce the old 0.5s polling loop for comparison"""
+
+    async def runnable(self) -> None:
+        while True:
+            if self.request_send.is_set():
+                self.last_code = await self.conn.request_next_code(self.identify_id)
+                if self.last_code is not None:
+                    await self.send(encode_response(200, 0, self.last_code))
+                    self.request_send.clear()
+            if self.stop_event.is_set():
+                return
+            await asyncio.sleep(0.5)
+
+
+STORAGE_ENGINES = {'sqlite': CodeStorage, 'memory': MemoryCodeStorage}
+storage_cls = CodeStorage
+
+
+def percentile(data: List[float], percent: float) -> float:
+    data = sorted(data)
+    return data[min(len(data) - 1, int(len(data) * percent))]
+
+
+def report(title: str, latencies: List[float]) -> None:
+    print(f'{title:<16} n={len(latencies):<6} mean={statistics.mean(latencies) * 1000:8.2f}ms '
+          f'p50={percentile(latencies, .5) * 1000:8.2f}ms p99={percentile(latencies, .99) * 1000:8.2f}ms')
+
+
+async def bench_dispatch(polling: bool, clients: int, rounds: int, fan_out: bool = False) -> List[float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        server = WebServer('', '127.0.0.1', 0, await storage_cls.new(os.path.join(tmp, 'bench.db')),
+                           fan_out=fan_out)
+        latencies = []
+        pending: Dict[str, int] = {}
+        received = asyncio.Event()
+        sent_at = 0.0
+
+        def on_code(code: str) -> None:
+            latencies.append(time.perf_counter() - sent_at)
+            pending[code] -= 1
+            if not pending[code]:
+                received.set()
+
+        coroutine_cls = PollingWsCoroutine if polling else WsCoroutine
+        sessions, tasks = [], []
+        for user in range(clients):
+            wsc = coroutine_cls(FakeWebSocket(on_code), server.conn, asyncio.Event())
+            wsc.identify_id = f'user{user}'
+            server.sessions.add(wsc)
+            sessions.append(wsc)
+            tasks.append(asyncio.create_task(wsc.runnable()))
+            wsc.req()
+
+        for round_ in range(rounds):
+            code = f'benchcode{round_:06d}'
+            pending[code] = clients
+            received.clear()
+            sent_at = time.perf_counter()
+            await server.put_passcode(code)
+            await received.wait()
+            for wsc in sessions:
+                wsc.req()
+            # Measure dispatch only, not the queries finding nothing left
+            while not polling and not all(wsc.caught_up for wsc in sessions):
+                await asyncio.sleep(0.001)
+
+        for wsc in sessions:
+            wsc.req_stop()
+        await asyncio.gather(*tasks)
+        await server.conn.close()
+        return latencies
+
+
+async def bench_assignment(size: int, users: int, requests: int) -> List[float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = await storage_cls.new(os.path.join(tmp, 'bench.db'))
+        await conn.insert_codes(f'benchcode{num:08d}' for num in range(size))
+        # Most codes are marked during an event, keep one live code in every ten
+        await conn.pool.writer.execute('''UPDATE "storage" SET "FR" = 1 WHERE "id" % 10 != 0''')
+        await conn.pool.writer.commit()
+        if isinstance(conn, MemoryCodeStorage):
+            await conn.load()
+        latencies = []
+        for _ in range(requests):
+            for user in range(users):
+                start = time.perf_counter()
+                await conn.request_next_code(f'user{user}')
+                latencies.append(time.perf_counter() - start)
+        await conn.close()
+        return latencies
+
+
+async def bench_startup(engine: str, size: int, users: int) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        config = ConfigParser()
+        config.read_dict({
+            'web': {'ws_prefix': '', 'bind': '127.0.0.1', 'port': '0'},
+            'storage': {'engine': engine, 'database': os.path.join(tmp, 'bench.db')},
+            'snapshot': {'enabled': 'true', 'file': os.path.join(tmp, 'bench.snapshot')},
+        })
+        conn = await CodeStorage.new(os.path.join(tmp, 'bench.db'))
+        await conn.insert_codes(f'benchcode{num:08d}' for num in range(size))
+        await conn.pool.writer.execute('BEGIN')
+        await conn.pool.writer.execute('''UPDATE "storage" SET "FR" = 1 WHERE "id" % 10 != 0''')
+        await conn.pool.writer.executemany('''INSERT INTO "user_status" VALUES (?, ?)''',
+                                           [(f'user{user}', user) for user in range(users)])
+        await conn.pool.writer.commit()
+        await conn.close()
+        result = {}
+        # First start finds no snapshot and scans database, then writes the snapshot used by second start
+        for title in ('database', 'snapshot'):
+            server = await WebServer.load_from_cfg(config)
+            result[title] = server.startup_seconds
+            await server.write_snapshot()
+            await server.conn.close()
+        return result
+
+
+async def bench_bridge(codes: int, bridged: bool) -> List[float]:
+    """Time spent in tracker hook per code, marking every other code, as inject mode does"""
+    with tempfile.TemporaryDirectory() as tmp:
+        server = WebServer('', '127.0.0.1', 0, await storage_cls.new(os.path.join(tmp, 'bench.db')))
+        put_passcode, mark_passcode = server.put_passcode, server.mark_passcode
+        bridge = None
+        if bridged:
+            bridge = PasscodeBridge(server.put_passcodes, server.mark_passcodes, seen=server.dedupe.__contains__)
+            bridge.start()
+            put_passcode, mark_passcode = bridge.put_passcode, bridge.mark_passcode
+        latencies = []
+        start = time.perf_counter()
+        for num in range(codes):
+            hook_start = time.perf_counter()
+            await put_passcode(f'bridgecode{num:06d}')
+            if num % 2:
+                await mark_passcode(f'bridgecode{num - 1:06d}', True)
+            latencies.append(time.perf_counter() - hook_start)
+            # Tracker handles other updates between codes
+            await asyncio.sleep(0)
+        if bridge is not None:
+            await bridge.close()
+        print(f'{"bridged" if bridged else "direct":<16} codes={codes} written in {time.perf_counter() - start:.3f}s')
+        await server.conn.close()
+        return latencies
+
+
+async def bench_slow_clients(clients: int, slow: int, rounds: int, queued: bool) -> List[float]:
+    """Time to insert a code and fan it out while `slow` of the clients take 0.2s to write every frame"""
+    with tempfile.TemporaryDirectory() as tmp:
+        server = WebServer('', '127.0.0.1', 0, await storage_cls.new(os.path.join(tmp, 'bench.db')),
+                           send_queue=64 if queued else 0)
+        received = asyncio.Event()
+        pending: Dict[str, int] = {}
+        fast_latencies = []
+        sent_at = 0.0
+
+        def on_code(code: str) -> None:
+            fast_latencies.append(time.perf_counter() - sent_at)
+            pending[code] -= 1
+            if not pending[code]:
+                received.set()
+
+        sessions = []
+        for user in range(clients + slow):
+            ws = FakeWebSocket(on_code) if user < clients else SlowWebSocket(0.2)
+            outbound = OutboundQueue(ws, server.send_queue, server.send_policy, server.outbound_limiter,
+                                     server.send_latency) if queued else None
+            wsc = WsCoroutine(ws, server.conn, asyncio.Event(), outbound=outbound)
+            wsc.identify_id = f'user{user}'
+            server.session_manager.open(wsc)
+            sessions.append(wsc)
+            wsc.req()
+        while not all(wsc.caught_up for wsc in sessions):
+            await asyncio.sleep(0.001)
+
+        put_latencies = []
+        for round_ in range(rounds):
+            code = f'benchcode{round_:06d}'
+            pending[code] = clients
+            received.clear()
+            sent_at = time.perf_counter()
+            await server.put_passcode(code)
+            put_latencies.append(time.perf_counter() - sent_at)
+            await received.wait()
+            for wsc in sessions:
+                wsc.req()
+            while not all(wsc.caught_up for wsc in sessions[:clients]):
+                await asyncio.sleep(0.001)
+
+        report(f'{"queued" if queued else "inline"} fast clients', fast_latencies)
+        await server.session_manager.stop()
+        await server.conn.close()
+        return put_latencies
+
+
+async def main(args: argparse.Namespace) -> None:
+    global storage_cls
+    storage_cls = STORAGE_ENGINES[args.engine]
+    if args.suite in ('all', 'dispatch'):
+        report('polling', await bench_dispatch(True, args.clients, args.rounds))
+        report('event-driven', await bench_dispatch(False, args.clients, args.rounds))
+        report('fan-out', await bench_dispatch(False, args.clients, args.rounds, True))
+    if args.suite in ('all', 'assignment'):
+        for size in args.sizes:
+            report(f'assign@{size}', await bench_assignment(size, 10, args.rounds))
+    if args.suite in ('all', 'startup'):
+        for size in args.sizes:
+            result = await bench_startup(args.engine, size, args.clients)
+            print(f'startup@{size:<9}' + ' '.join(f'{title}={seconds * 1000:8.2f}ms'
+                                                  for title, seconds in result.items()))
+    if args.suite in ('all', 'bridge'):
+        report('hook direct', await bench_bridge(args.rounds * 100, False))
+        report('hook bridged', await bench_bridge(args.rounds * 100, True))
+    if args.suite in ('all', 'slow'):
+        report('put inline', await bench_slow_clients(args.clients, args.clients // 20 or 1, args.rounds, False))
+        report('put queued', await bench_slow_clients(args.clients, args.clients // 20 or 1, args.rounds, True))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('receiver.website').setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description='Code server benchmark')
+    parser.add_argument('suite', nargs='?', default='all', choices=('all', 'dispatch', 'assignment', 'startup',
+                                                                    'bridge', 'slow'))
+    parser.add_argument('--engine', default='sqlite', choices=STORAGE_ENGINES.keys(), help='Storage engine')
+    parser.add_argument('--clients', type=int, default=300, help='Simulated clients')
+    parser.add_argument('--rounds', type=int, default=10, help='Codes put (or requested per user) during benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 500000],
+                        help='Table sizes of assignment and startup benchmark')
+    asyncio.run(main(parser.parse_args()))
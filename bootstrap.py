@@ -20,17 +20,21 @@ import logging
 import sys
 from configparser import ConfigParser
 
-import aiofiles
 from injectmode import WebServer as MixinServer
-from localserver import WebServer as TraditionalServer
+from libloader import PasscodeLoader
+from localserver import WebServer as TraditionalServer, spawn_workers, stop_workers
 from receiver import Receiver
 
 
-async def main(debug: bool, load_from_file: bool, start_website_only: bool, is_inject: bool) -> None:
+async def main(debug: bool, load_from_file: bool, watch_file: bool, start_website_only: bool,
+               is_inject: bool, profile: bool = False) -> None:
+    workers = []
+    config = ConfigParser()
+    config.read('config.ini')
     if not is_inject:
-        config = ConfigParser()
-        config.read('config.ini')
-        website = await TraditionalServer.load_from_cfg(config, debug)
+        website = await TraditionalServer.load_from_cfg(config, debug, profile=profile)
+        # Spawn after database initialized by main process
+        workers = spawn_workers('config.ini', config.getint('web', 'workers', fallback=1) - 1, debug, profile)
         instance = website
         code_mutable_instance = website
 
@@ -40,22 +44,28 @@ async def main(debug: bool, load_from_file: bool, start_website_only: bool, is_i
                 config.get('telegram', 'api_hash'),
                 config.get('server', 'bot_token'),
                 config.getint('server', 'listen_user'),
-                website
+                website,
+                reply_summary=config.getboolean('server', 'reply_summary', fallback=False),
+                max_pending=config.getint('server', 'ingest_queue', fallback=64),
+                batch_size=config.getint('server', 'ingest_batch', fallback=500)
             )
     else:
-        instance = await MixinServer.new(debug)
+        instance = await MixinServer.new(debug, profile)
         code_mutable_instance = instance
 
-    if load_from_file:
-        async with aiofiles.open('passcode.txt') as fin:
-            for code in await fin.readlines():
-                if len(code) == 0:
-                    break
-                await code_mutable_instance.put_passcode(code.strip())
+    loader = None
+    if load_from_file or watch_file:
+        loader = PasscodeLoader.load_from_cfg(config, code_mutable_instance.put_passcodes)
 
     await instance.start()
+    # Load in background, so clients are accepted while large file is loading
+    if loader is not None:
+        loader.start(config.getfloat('loader', 'watch_interval', fallback=1.0) if watch_file else 0)
     await instance.idle()
+    if loader is not None:
+        await loader.stop()
     await instance.stop()
+    stop_workers(workers)
 
 
 if __name__ == '__main__':
@@ -73,10 +83,12 @@ if __name__ == '__main__':
 
     debug_mode = '--debug' in sys.argv
     _load_from_file = '--load' in sys.argv
+    _watch_file = '--watch' in sys.argv
     server_core_only = '--nbot' in sys.argv
     inject_mode = '--inject' in sys.argv
+    profile_mode = '--profile' in sys.argv
 
     if inject_mode and server_core_only:
         logging.warning('In inject mode, server code option will ignored')
 
-    asyncio.run(main(debug_mode, _load_from_file, server_core_only, inject_mode))
+    asyncio.run(main(debug_mode, _load_from_file, _watch_file, server_core_only, inject_mode, profile_mode))
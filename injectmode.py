@@ -16,12 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from configparser import ConfigParser
-from typing import Callable
+from typing import Callable, Iterable
 import os
 
 import aioredis
 
 from forwarder.bot import Tracker, PasscodeTracker
+from libingest import PasscodeBridge
+from libsqlite import InsertResult
 from localserver import WebServer as Server
 
 
@@ -46,28 +48,43 @@ class RewriteTracker(Tracker):
 
 
 class WebServer:
-    def __init__(self, tracker: RewriteTracker, web_server: Server):
+    def __init__(self, tracker: RewriteTracker, web_server: Server, *, max_pending: int = 1024,
+                 batch_size: int = 500, linger: float = 0.05):
         self.tracker = tracker
         self.web_server = web_server
-        self.tracker.register_hook_functions(self.put_passcode, self.mark_passcode)
+        # Tracker hooks only buffer, so the bot never waits for code server storage
+        self.bridge = PasscodeBridge(web_server.put_passcodes, web_server.mark_passcodes,
+                                     seen=web_server.dedupe.__contains__, max_pending=max_pending,
+                                     batch_size=batch_size, linger=linger)
+        self.tracker.register_hook_functions(self.bridge.put_passcode, self.bridge.mark_passcode)
 
     @classmethod
-    async def new(cls, debug: bool = False) -> 'WebServer':
+    async def new(cls, debug: bool = False, profile: bool = False) -> 'WebServer':
         config_tracker, config_web_server = ConfigParser(), ConfigParser()
         config_web_server.read('config.ini')
         config_tracker.read(os.path.join('forwarder', 'config.ini'))
         return cls(
             await RewriteTracker.load_from_config(
                 config_tracker, debug=debug, database_file=os.path.join('forwarder', 'codes.db')),
-            await Server.load_from_cfg(config_web_server, debug))
+            await Server.load_from_cfg(config_web_server, debug, profile=profile),
+            max_pending=config_web_server.getint('inject', 'max_pending', fallback=1024),
+            batch_size=config_web_server.getint('inject', 'batch_size', fallback=500),
+            linger=config_web_server.getfloat('inject', 'linger', fallback=0.05))
 
     async def start(self) -> None:
         await self.web_server.start()
+        self.bridge.start()
         await self.tracker.start()
 
     async def stop(self) -> None:
-        await self.tracker.stop()
-        await self.web_server.stop()
+        # Web server and its storage are shut down even when writing what the bridge buffered fails
+        try:
+            await self.tracker.stop()
+        finally:
+            try:
+                await self.bridge.close()
+            finally:
+                await self.web_server.stop()
 
     async def idle(self) -> None:
         await self.web_server.idle()
@@ -75,5 +92,8 @@ class WebServer:
     async def put_passcode(self, passcode: str) -> None:
         await self.web_server.put_passcode(passcode)
 
+    async def put_passcodes(self, passcodes: Iterable[str]) -> InsertResult:
+        return await self.web_server.put_passcodes(passcodes)
+
     async def mark_passcode(self, passcode: str, is_fr: bool) -> None:
         await self.web_server.mark_passcode(passcode, is_fr)
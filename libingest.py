@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# libingest.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import logging
+import re
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from libsqlite import InsertResult
+
+PASSCODE_EXP = re.compile(r'^\w{5,20}$')
+
+logger = logging.getLogger("code_master").getChild("ingest")
+logger.setLevel(logging.getLogger("code_master").level)
+
+
+class IngestResult(NamedTuple):
+    accepted: int
+    duplicated: int
+    invalid: int
+
+
+def parse_passcodes(text: str) -> Tuple[List[str], List[str]]:
+    """Split text to valid and invalid codes, skip empty lines, comments and commands"""
+    valid, invalid = [], []
+    for code in text.splitlines(False):
+        code = code.strip()
+        if not code or code.startswith(('#', '/')):
+            continue
+        if PASSCODE_EXP.match(code) is None:
+            invalid.append(code)
+        else:
+            valid.append(code)
+    return valid, invalid
+
+
+class IngestPipeline:
+    """
+    Bounded queue between message handler and storage. Handler returns as soon as text is queued,
+    a single consumer validates queued messages, inserts them in one batch (dedupe and notify are
+    done by `put_passcodes`). Handler waits for a free slot when queue is full.
+    """
+
+    def __init__(self, put_passcodes: Callable[[Iterable[str]], Awaitable[InsertResult]], *,
+                 max_pending: int = 64, batch_size: int = 500):
+        self.put_passcodes = put_passcodes
+        self.batch_size = batch_size
+        self.queue: 'asyncio.Queue[Tuple[str, Optional[Callable[[IngestResult], Awaitable[None]]]]]' = \
+            asyncio.Queue(max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks: Set[asyncio.Task] = set()
+
+    async def submit(self, text: str, on_done: Optional[Callable[[IngestResult], Awaitable[None]]] = None) -> None:
+        await self.queue.put((text, on_done))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            items = [await self.queue.get()]
+            # Merge messages already waiting into the same insert
+            lines = items[0][0].count('\n') + 1
+            while lines < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                lines += items[-1][0].count('\n') + 1
+            try:
+                await self._process(items)
+            except Exception:
+                logger.exception('Got exception while ingesting %d message(s)', len(items))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    async def _process(self, items: List[Tuple[str, Optional[Callable[[IngestResult], Awaitable[None]]]]]) -> None:
+        parsed = [parse_passcodes(text) for text, _ in items]
+        result = await self.put_passcodes(code for valid, _ in parsed for code in valid)
+        inserted = set(result.inserted)
+        for (valid, invalid), (_, on_done) in zip(parsed, items):
+            for code in invalid:
+                logger.warning('Skipped code => %s', code)
+            accepted = 0
+            for code in valid:
+                if code.lower() in inserted:
+                    inserted.discard(code.lower())
+                    accepted += 1
+            summary = IngestResult(accepted, len(valid) - accepted, len(invalid))
+            logger.info('Put %d passcode(s), %d duplicated, %d invalid', *summary)
+            if on_done is not None:
+                # Do not hold next batch for the reply
+                task = asyncio.create_task(on_done(summary))
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        await self.queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.gather(*self._callbacks, return_exceptions=True)
+
+
+class PasscodeBridge:
+    """
+    Bounded, coalescing buffer between tracker hooks and web server in inject mode. Hooks return as soon
+    as the code or mark is buffered, a single consumer writes what gathered during `linger` seconds as one
+    batch insert and one batch mark. Codes already known by web server or already buffered are dropped,
+    later mark of the same code replaces the earlier one. Hooks only wait when `max_pending` is reached.
+    """
+
+    def __init__(self, put_passcodes: Callable[[List[str]], Awaitable[InsertResult]],
+                 mark_passcodes: Callable[[List[Tuple[str, bool, bool]]], Awaitable[None]], *,
+                 seen: Optional[Callable[[str], bool]] = None, max_pending: int = 1024, batch_size: int = 500,
+                 linger: float = 0.05):
+        self.put_passcodes = put_passcodes
+        self.mark_passcodes = mark_passcodes
+        self.seen = seen
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.linger = linger
+        self.codes: 'OrderedDict[str, None]' = OrderedDict()
+        self.marks: Dict[str, Tuple[bool, bool]] = {}
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def __len__(self) -> int:
+        return len(self.codes) + len(self.marks)
+
+    async def _wait_space(self) -> None:
+        while len(self) >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+
+    async def put_passcode(self, code: str) -> None:
+        code = code.lower()
+        if code in self.codes or (self.seen is not None and self.seen(code)):
+            return
+        await self._wait_space()
+        self.codes[code] = None
+        self._wakeup.set()
+
+    async def mark_passcode(self, code: str, is_fr: bool, is_other: bool = False) -> None:
+        code = code.lower()
+        if code not in self.marks:
+            await self._wait_space()
+        self.marks[code] = (is_fr, is_other)
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closing:
+            await self._wakeup.wait()
+            if not self._closing:
+                # Let a burst gather into the same batch
+                await asyncio.sleep(self.linger)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Got exception while writing bridged codes, retry later')
+                if not self._closing:
+                    await asyncio.sleep(1)
+
+    async def flush(self) -> None:
+        # Take both at once, so a mark is never written before insert of the same code
+        codes, self.codes = list(self.codes), OrderedDict()
+        marks, self.marks = self.marks, {}
+        self._space.set()
+        written = 0
+        try:
+            for offset in range(0, len(codes), self.batch_size):
+                result = await self.put_passcodes(codes[offset:offset + self.batch_size])
+                written = offset + self.batch_size
+                logger.debug('Bridged %d code(s), %d duplicated', len(result.inserted), len(result.duplicated))
+            items = [(code, *mark) for code, mark in marks.items()]
+            for offset in range(0, len(items), self.batch_size):
+                batch = items[offset:offset + self.batch_size]
+                await self.mark_passcodes(batch)
+                for code, *_ in batch:
+                    del marks[code]
+        except Exception:
+            # Put back what is not written, ahead of what was buffered meanwhile, newer marks win
+            self.codes = OrderedDict.fromkeys([*codes[written:], *self.codes])
+            for code, mark in marks.items():
+                self.marks.setdefault(code, mark)
+            self._wakeup.set()
+            raise
+
+    async def close(self) -> None:
+        """Write everything buffered, batch in progress is completed rather than cancelled"""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# libloader.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import logging
+import os
+from configparser import ConfigParser
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import aiofiles
+
+from libingest import PASSCODE_EXP
+from libsqlite import InsertResult
+
+logger = logging.getLogger("code_master").getChild("loader")
+logger.setLevel(logging.getLogger("code_master").level)
+
+
+class PasscodeLoader:
+    """
+    Stream passcode file(s) into storage in batches. Byte offset of every file is checkpointed after
+    each batch, so restart resumes from where it stopped, and watching picks up appended lines only.
+    """
+
+    def __init__(self, path: str, put_passcodes: Callable[[Iterable[str]], Awaitable[InsertResult]], *,
+                 checkpoint_file: Optional[str] = None, chunk_size: int = 65536, batch_size: int = 500):
+        self.path = path
+        self.put_passcodes = put_passcodes
+        self.checkpoint_file = checkpoint_file
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.checkpoint: Dict[str, Dict[str, int]] = self._read_checkpoint()
+        # Set when files are loaded again for appended lines
+        self.watching = False
+        # Size of files whose last line had no tailing newline, at the round it was seen
+        self._tails: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def load_from_cfg(cls, config: ConfigParser,
+                      put_passcodes: Callable[[Iterable[str]], Awaitable[InsertResult]]) -> 'PasscodeLoader':
+        return cls(config.get('loader', 'path', fallback='passcode.txt'), put_passcodes,
+                   checkpoint_file=config.get('loader', 'checkpoint', fallback='passcode.checkpoint') or None,
+                   chunk_size=config.getint('loader', 'chunk_size', fallback=65536),
+                   batch_size=config.getint('loader', 'batch_size', fallback=500))
+
+    def _read_checkpoint(self) -> Dict[str, Dict[str, int]]:
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return {}
+        try:
+            with open(self.checkpoint_file) as fin:
+                return json.load(fin)
+        except ValueError:
+            logger.warning('Checkpoint file %s is broken, load from beginning', self.checkpoint_file)
+            return {}
+
+    def _write_checkpoint(self) -> None:
+        if self.checkpoint_file is None:
+            return
+        with open(f'{self.checkpoint_file}.tmp', 'w') as fout:
+            json.dump(self.checkpoint, fout)
+        os.replace(f'{self.checkpoint_file}.tmp', self.checkpoint_file)
+
+    def files(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                          if name.endswith('.txt') and os.path.isfile(os.path.join(self.path, name)))
+        return [self.path] if os.path.isfile(self.path) else []
+
+    async def _put(self, codes: List[str], file_name: str, offset: int, inode: int) -> None:
+        if codes:
+            result = await self.put_passcodes(codes)
+            logger.debug('Loaded %d passcode(s) from %s, %d duplicated',
+                         len(result.inserted), file_name, len(result.duplicated))
+        self.checkpoint[file_name] = {'offset': offset, 'inode': inode}
+        self._write_checkpoint()
+
+    @staticmethod
+    def parse_line(line: bytes) -> Optional[str]:
+        code = line.decode(errors='ignore').strip()
+        if not code or code.startswith('#'):
+            return None
+        if PASSCODE_EXP.match(code) is None:
+            logger.warning('Skipped code => %s', code)
+            return None
+        return code
+
+    async def load_file(self, file_name: str) -> int:
+        stat = os.stat(file_name)
+        saved = self.checkpoint.get(file_name, {})
+        offset = saved.get('offset', 0)
+        # File replaced or truncated, start over
+        if saved.get('inode') != stat.st_ino or offset > stat.st_size:
+            offset = 0
+        if offset == stat.st_size:
+            return 0
+        loaded = 0
+        batch: List[str] = []
+        remain = b''
+        async with aiofiles.open(file_name, 'rb') as fin:
+            await fin.seek(offset)
+            while chunk := await fin.read(self.chunk_size):
+                lines = (remain + chunk).split(b'\n')
+                remain = lines.pop()
+                for line in lines:
+                    offset += len(line) + 1
+                    code = self.parse_line(line)
+                    if code is None:
+                        continue
+                    batch.append(code)
+                    if len(batch) >= self.batch_size:
+                        await self._put(batch, file_name, offset, stat.st_ino)
+                        loaded += len(batch)
+                        batch = []
+        if remain:
+            # Last line without tailing newline may still be written while watching,
+            # it is taken once the file has not grown for a round
+            if not self.watching or self._tails.get(file_name) == stat.st_size:
+                self._tails.pop(file_name, None)
+                offset += len(remain)
+                code = self.parse_line(remain)
+                if code is not None:
+                    batch.append(code)
+            else:
+                self._tails[file_name] = stat.st_size
+        await self._put(batch, file_name, offset, stat.st_ino)
+        return loaded + len(batch)
+
+    async def load(self) -> int:
+        loaded = 0
+        for file_name in self.files():
+            # Checkpoint is not moved past a failed batch, so it is loaded again next round
+            try:
+                loaded += await self.load_file(file_name)
+            except Exception:
+                logger.exception('Got exception while loading %s', file_name)
+        if loaded:
+            logger.info('Loaded %d passcode(s) from %s', loaded, self.path)
+        return loaded
+
+    async def _run(self, watch_interval: float) -> None:
+        await self.load()
+        while watch_interval > 0:
+            await asyncio.sleep(watch_interval)
+            await self.load()
+
+    def start(self, watch_interval: float = 0) -> None:
+        self.watching = watch_interval > 0
+        self._task = asyncio.create_task(self._run(watch_interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.exception('Got exception while loading passcode')
+            self._task = None
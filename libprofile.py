@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# libprofile.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, Optional
+
+from libmetrics import Histogram, Registry
+
+logger = logging.getLogger("code_master").getChild("profile")
+logger.setLevel(logging.getLogger("code_master").level)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Profiler:
+    """
+    Storage calls are always timed for metrics. When enabled, handling stages and lock hold time
+    are timed too, slow operations are logged with their context and event loop lag is watched.
+    """
+
+    def __init__(self, storage_latency: Optional[Histogram] = None, registry: Optional[Registry] = None, *,
+                 enabled: bool = False, slow_threshold: float = 0.1, lag_interval: float = 0.1):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.lag_interval = lag_interval
+        self.storage_latency = storage_latency if storage_latency is not None else \
+            Histogram('storage_seconds', 'Unregistered', ('operation',))
+        registry = registry if registry is not None else Registry()
+        self.stage_latency = self.lock_held = self.loop_lag = None
+        if enabled:
+            self.stage_latency = registry.register(
+                Histogram('codeserver_stage_seconds', 'Latency of message handling stages', ('stage',)))
+            self.lock_held = registry.register(
+                Histogram('codeserver_sqlite_lock_held_seconds', 'Time SQLite lock was held'))
+            self.loop_lag = registry.register(
+                Histogram('codeserver_loop_lag_seconds', 'Delay of event loop wake up'))
+        self.max_lag = 0.0
+        self.slow_operations = 0
+        self._lag_task: Optional[asyncio.Task] = None
+        self._loop_thread: Optional[int] = None
+
+    def _check_slow(self, kind: str, name: str, elapsed: float, context: Dict[str, Any]) -> None:
+        if elapsed >= self.slow_threshold:
+            self.slow_operations += 1
+            logger.warning('Slow %s %s took %.3fs%s', kind, name, elapsed,
+                           ''.join(f' {key}={value}' for key, value in context.items()))
+
+    @contextmanager
+    def _timed(self, histogram: Histogram, kind: str, name: str, context: Dict[str, Any]) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed, name)
+            self._check_slow(kind, name, elapsed, context)
+
+    def stage(self, name: str, **context: Any) -> ContextManager[None]:
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(self.stage_latency, 'stage', name, context)
+
+    def storage(self, operation: str, **context: Any) -> ContextManager[None]:
+        if not self.enabled:
+            return self.storage_latency.time(operation)
+        return self._timed(self.storage_latency, 'storage', operation, context)
+
+    def on_lock_held(self, seconds: float) -> None:
+        if self.enabled:
+            self.lock_held.observe(seconds)
+            self._check_slow('lock', 'held', seconds, {})
+
+    async def _watch_lag(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            lag = time.perf_counter() - start - self.lag_interval
+            self.loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self._check_slow('loop', 'lag', lag, {})
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        if self.enabled:
+            self._lag_task = asyncio.create_task(self._watch_lag())
+
+    def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    def lag_stats(self) -> Dict[str, Any]:
+        data = self.loop_lag.values.get(()) if self.loop_lag is not None else None
+        count = sum(data[:-1]) if data else 0
+        stats = {'samples': count, 'mean': data[-1] / count if count else 0, 'max': self.max_lag,
+                 'slow_operations': self.slow_operations}
+        self.max_lag = 0.0
+        return stats
+
+    def _sample(self, seconds: float, interval: float) -> 'collections.Counter[str]':
+        stacks: 'collections.Counter[str]' = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:'
+                             f'{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def sample(self, seconds: float, interval: float = 0.005) -> str:
+        """Sample stacks of event loop thread from another thread, output is collapsed stack format"""
+        stacks = await asyncio.get_running_loop().run_in_executor(None, self._sample, seconds, interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# libredis.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import logging
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import aioredis
+
+from libsqlite import InsertResult, MarkBuffer
+
+logger = logging.getLogger("code_master").getChild("redis")
+logger.setLevel(logging.getLogger("code_master").level)
+
+# KEYS: seq, all, live, created  ARGV: now, codes...
+_INSERT_SCRIPT = '''
+local inserted = {}
+for i = 2, #ARGV do
+    local code = ARGV[i]
+    if not redis.call('ZSCORE', KEYS[2], code) then
+        local id = redis.call('INCR', KEYS[1])
+        redis.call('ZADD', KEYS[2], id, code)
+        redis.call('ZADD', KEYS[3], id, code)
+        redis.call('ZADD', KEYS[4], ARGV[1], code)
+        inserted[#inserted + 1] = code
+    end
+end
+return inserted
+'''
+
+# KEYS: live, cursors  ARGV: user, count
+_ASSIGN_SCRIPT = '''
+local cursor = redis.call('HGET', KEYS[2], ARGV[1]) or '0'
+local next = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. cursor, '+inf', 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+if #next == 0 then
+    return {}
+end
+redis.call('HSET', KEYS[2], ARGV[1], next[#next])
+local codes = {}
+for i = 1, #next, 2 do
+    codes[#codes + 1] = next[i]
+end
+return codes
+'''
+
+# KEYS: all, cursors  ARGV: code, users...
+_ADVANCE_SCRIPT = '''
+local id = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not id then
+    return 0
+end
+for i = 2, #ARGV do
+    if tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0') < tonumber(id) then
+        redis.call('HSET', KEYS[2], ARGV[i], id)
+    end
+end
+return 1
+'''
+
+# KEYS: all, live, marks  ARGV: code, FR, other
+_MARK_SCRIPT = '''
+local id = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not id then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2] .. ARGV[3])
+if ARGV[2] == '1' or ARGV[3] == '1' then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+else
+    redis.call('ZADD', KEYS[2], id, ARGV[1])
+end
+return 1
+'''
+
+# Oldest live code not tried by user and not held by anyone else, expired lease is taken over.
+# Scan starts after the user's floor, the id up to which every live code is tried by the user,
+# and gives up after `limit` codes, so a call never blocks redis for long
+# KEYS: live, leases, owners, tried, floors  ARGV: user, now, expires_at, batch, limit
+_LEASE_SCRIPT = '''
+local batch = tonumber(ARGV[4])
+local limit = tonumber(ARGV[5])
+local floor = redis.call('HGET', KEYS[5], ARGV[1]) or '0'
+local from = floor
+local advancing = true
+local scanned = 0
+local found = false
+while not found and scanned < limit do
+    local live = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. from, '+inf', 'WITHSCORES', 'LIMIT', 0, batch)
+    if #live == 0 then
+        break
+    end
+    for i = 1, #live, 2 do
+        local code, id = live[i], live[i + 1]
+        from = id
+        scanned = scanned + 1
+        if redis.call('SISMEMBER', KEYS[4], id) == 1 then
+            if advancing then
+                floor = id
+            end
+        else
+            advancing = false
+            local expires_at = redis.call('ZSCORE', KEYS[2], code)
+            if not expires_at or tonumber(expires_at) <= tonumber(ARGV[2]) then
+                redis.call('ZADD', KEYS[2], ARGV[3], code)
+                redis.call('HSET', KEYS[3], code, ARGV[1])
+                found = code
+                break
+            end
+        end
+        if scanned >= limit then
+            break
+        end
+    end
+end
+redis.call('HSET', KEYS[5], ARGV[1], floor)
+return found
+'''
+
+# Drop dead codes among next `step` codes after id `from`, marked ones and ones inserted before cutoff
+# Returns id of last code scanned (0 at the end) followed by code and id of each dropped code
+# KEYS: all, live, marks, leases, owners, created  ARGV: from, cutoff, step
+_COMPACT_SCRIPT = '''
+local scanned = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+if #scanned == 0 then
+    return {0}
+end
+local result = {scanned[#scanned]}
+local cutoff = tonumber(ARGV[2])
+for i = 1, #scanned, 2 do
+    local code = scanned[i]
+    local mark = redis.call('HGET', KEYS[3], code)
+    -- Codes inserted before insert time was recorded are only dead once marked
+    local created = tonumber(redis.call('ZSCORE', KEYS[6], code) or cutoff)
+    if (mark and mark ~= '00') or created < cutoff then
+        redis.call('ZREM', KEYS[1], code)
+        redis.call('ZREM', KEYS[2], code)
+        redis.call('HDEL', KEYS[3], code)
+        redis.call('ZREM', KEYS[4], code)
+        redis.call('HDEL', KEYS[5], code)
+        redis.call('ZREM', KEYS[6], code)
+        result[#result + 1] = code
+        result[#result + 1] = scanned[i + 1]
+    end
+end
+return result
+'''
+
+# Drop lease of user, and record the code as tried when ARGV[3] is 1
+# KEYS: all, leases, owners, tried  ARGV: user, code, tried
+_RELEASE_SCRIPT = '''
+local id = redis.call('ZSCORE', KEYS[1], ARGV[2])
+if not id then
+    return 0
+end
+if ARGV[3] == '1' then
+    redis.call('SADD', KEYS[4], id)
+end
+if redis.call('HGET', KEYS[3], ARGV[2]) == ARGV[1] then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    redis.call('HDEL', KEYS[3], ARGV[2])
+end
+return 1
+'''
+
+
+class RedisCodeStorage:
+    """
+    Codes shared through redis, so several servers can hand out from the same stream.
+    Every code is in `all` sorted set scored by its id, live codes also in `live` sorted set,
+    user cursors in `cursors` hash. Assignment is a server-side script, so it is atomic.
+    Exclusive assignment keeps held codes in `leases` sorted set scored by expiry with holders in `owners` hash,
+    ids of codes tried by a user in `tried:<user>` set, and in `floors` hash the id up to which all are tried.
+    Insert time of codes is in `created` sorted set, dead codes are dropped by compaction,
+    so unlike sqlite they can be inserted again afterwards.
+    """
+
+    def __init__(self, redis: aioredis.Redis, prefix: str = 'codeserver'):
+        self.redis = redis
+        self.key_seq = f'{prefix}:seq'
+        self.key_all = f'{prefix}:all'
+        self.key_live = f'{prefix}:live'
+        self.key_marks = f'{prefix}:marks'
+        self.key_cursors = f'{prefix}:cursors'
+        self.key_leases = f'{prefix}:leases'
+        self.key_owners = f'{prefix}:owners'
+        self.key_tried = f'{prefix}:tried:'
+        self.key_created = f'{prefix}:created'
+        self.key_floors = f'{prefix}:floors'
+        self._insert = redis.register_script(_INSERT_SCRIPT)
+        self._assign = redis.register_script(_ASSIGN_SCRIPT)
+        self._mark = redis.register_script(_MARK_SCRIPT)
+        self._advance = redis.register_script(_ADVANCE_SCRIPT)
+        self._lease = redis.register_script(_LEASE_SCRIPT)
+        self._release = redis.register_script(_RELEASE_SCRIPT)
+        self._compact = redis.register_script(_COMPACT_SCRIPT)
+        self._compact_from = 0
+        # Not used by redis storage, kept for interface compatibility
+        self.mark_buffer: Optional[MarkBuffer] = None
+        self.on_lock_wait: Optional[Callable[[str, float], None]] = None
+        self.on_lock_held: Optional[Callable[[float], None]] = None
+
+    @classmethod
+    async def new(cls, url: str, *, prefix: str = 'codeserver', renew: bool = False) -> 'RedisCodeStorage':
+        self = cls(aioredis.from_url(url, decode_responses=True), prefix)
+        if renew:
+            await self.redis.delete(self.key_seq, self.key_all, self.key_live, self.key_marks, self.key_cursors,
+                                    self.key_leases, self.key_owners, self.key_created, self.key_floors)
+            async for key in self.redis.scan_iter(match=f'{self.key_tried}*'):
+                await self.redis.delete(key)
+        return self
+
+    async def close(self) -> None:
+        await self.redis.close()
+
+    async def insert_code(self, code: str) -> bool:
+        return bool(await self._insert(keys=[self.key_seq, self.key_all, self.key_live, self.key_created],
+                                       args=[int(time.time()), code.lower()]))
+
+    async def insert_codes(self, codes: Iterable[str], *, chunk_size: int = 500) -> InsertResult:
+        codes = [code.lower() for code in codes]
+        candidate = list(dict.fromkeys(codes))
+        created = set()
+        for offset in range(0, len(candidate), chunk_size):
+            created.update(await self._insert(keys=[self.key_seq, self.key_all, self.key_live, self.key_created],
+                                              args=[int(time.time()), *candidate[offset:offset + chunk_size]]))
+        inserted = [code for code in candidate if code in created]
+        duplicated = []
+        for code in codes:
+            if code in created:
+                created.discard(code)
+            else:
+                duplicated.append(code)
+        return InsertResult(inserted, duplicated)
+
+    async def delete_code(self, code: str) -> None:
+        code = code.lower()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.key_all, code)
+            pipe.zrem(self.key_live, code)
+            pipe.hdel(self.key_marks, code)
+            pipe.zrem(self.key_leases, code)
+            pipe.hdel(self.key_owners, code)
+            pipe.zrem(self.key_created, code)
+            await pipe.execute()
+
+    async def mark_code(self, code: str, is_fr: bool, other: bool = False) -> None:
+        await self._mark(keys=[self.key_all, self.key_live, self.key_marks],
+                         args=[code.lower(), int(is_fr), int(other)])
+
+    async def mark_codes(self, marks: Iterable[Tuple[str, bool, bool]]) -> None:
+        for code, is_fr, other in marks:
+            await self.mark_code(code, is_fr, other)
+
+    async def request_next_code(self, user: str) -> Optional[str]:
+        codes = await self.request_next_codes(user, 1)
+        return codes[0] if codes else None
+
+    async def request_next_codes(self, user: str, count: int) -> List[str]:
+        return await self._assign(keys=[self.key_live, self.key_cursors], args=[user, count])
+
+    async def assign_code(self, code: str, users: List[str]) -> None:
+        await self._advance(keys=[self.key_all, self.key_cursors], args=[code.lower(), *users])
+
+    async def lease_next_code(self, user: str, timeout: float, *, batch: int = 100,
+                              limit: int = 1000) -> Optional[str]:
+        """Hold oldest code not tried by user for `timeout` seconds, None if not found among `limit` codes"""
+        now = time.time()
+        return await self._lease(keys=[self.key_live, self.key_leases, self.key_owners, self.key_tried + user,
+                                       self.key_floors],
+                                 args=[user, repr(now), repr(now + timeout), batch, limit])
+
+    async def complete_lease(self, user: str, code: str) -> None:
+        await self._release(keys=[self.key_all, self.key_leases, self.key_owners, self.key_tried + user],
+                            args=[user, code.lower(), 1])
+
+    async def release_lease(self, user: str, code: str) -> None:
+        await self._release(keys=[self.key_all, self.key_leases, self.key_owners, self.key_tried + user],
+                            args=[user, code.lower(), 0])
+
+    async def fetch_recent_codes(self, limit: int) -> List[str]:
+        return await self.redis.zrange(self.key_all, -limit, -1)
+
+    async def latest_code_id(self) -> int:
+        return int(await self.redis.get(self.key_seq) or 0)
+
+    async def compact_step(self, ttl: float = 0, step: int = 500) -> List[str]:
+        """
+        Drop next dead codes from every key, return codes dropped. Empty list means the scan reached the end,
+        and next call starts over from beginning. Each script call scans at most `step` codes.
+        """
+        cutoff = int(time.time() - ttl) if ttl > 0 else 0
+        while True:
+            result = await self._compact(keys=[self.key_all, self.key_live, self.key_marks, self.key_leases,
+                                               self.key_owners, self.key_created],
+                                         args=[self._compact_from, cutoff, step])
+            self._compact_from = int(result[0])
+            codes, code_ids = result[1::2], result[2::2]
+            if code_ids:
+                # Ids are never reused, tried ids of dropped codes are no longer needed
+                async for key in self.redis.scan_iter(match=f'{self.key_tried}*'):
+                    await self.redis.srem(key, *code_ids)
+            if codes or not self._compact_from:
+                return codes
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# libsnapshot.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from libsqlite import MemoryCodeStorage
+from libstorage import CodeStorageBackend
+
+logger = logging.getLogger("code_master").getChild("snapshot")
+logger.setLevel(logging.getLogger("code_master").level)
+
+
+async def current_fingerprint(conn: CodeStorageBackend) -> List[int]:
+    """Identify storage state, snapshot is only used when it matches storage"""
+    if isinstance(conn, MemoryCodeStorage):
+        return list(conn.memory_fingerprint())
+    return [await conn.latest_code_id()]
+
+
+class Snapshot:
+    """
+    Hot state of server: dedupe index, and live index and cursors of in-memory storage.
+    Code lists are newline joined and id arrays are raw bytes, so loading is a few splits
+    rather than decoding an object per code.
+    """
+    version = 1
+
+    def __init__(self, fingerprint: List[int], dedupe: List[str], storage: Optional[Dict[str, Any]] = None,
+                 written_at: Optional[float] = None):
+        self.fingerprint = fingerprint
+        self.dedupe = dedupe
+        self.storage = storage
+        self.written_at = time.time() if written_at is None else written_at
+
+    @classmethod
+    async def take(cls, conn: CodeStorageBackend, dedupe: List[str]) -> 'Snapshot':
+        if isinstance(conn, MemoryCodeStorage):
+            # Flush first, so database matches memory and the snapshot is usable on next start
+            await conn.flush()
+            return cls(list(conn.memory_fingerprint()), dedupe, conn.export_state())
+        return cls(await current_fingerprint(conn), dedupe)
+
+    async def matches(self, conn: CodeStorageBackend) -> bool:
+        return self.fingerprint == await current_fingerprint(conn)
+
+    @classmethod
+    def load(cls, file_name: str, max_age: float = 0) -> Optional['Snapshot']:
+        try:
+            with open(file_name) as fin:
+                data = json.load(fin)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning('Snapshot %s is broken, ignored', file_name)
+            return None
+        if data.get('version') != cls.version:
+            logger.info('Snapshot %s is written by another version, ignored', file_name)
+            return None
+        if max_age > 0 and time.time() - data['written_at'] > max_age:
+            logger.info('Snapshot %s is older than %d seconds, ignored', file_name, max_age)
+            return None
+        return cls(data['fingerprint'], data['dedupe'].split('\n') if data['dedupe'] else [], data['storage'],
+                   data['written_at'])
+
+    def dump(self, file_name: str) -> None:
+        with open(f'{file_name}.tmp', 'w') as fout:
+            json.dump({'version': self.version, 'written_at': self.written_at, 'fingerprint': self.fingerprint,
+                       'dedupe': '\n'.join(self.dedupe), 'storage': self.storage}, fout)
+        os.replace(f'{file_name}.tmp', file_name)
@@ -14,8 +14,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import base64
+import json
 import logging
-from typing import Optional
+import sqlite3
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 import aiosqlite
 
@@ -43,37 +51,448 @@ _DROP_STATEMENT_CodeStorage = '''
     DROP TABLE IF EXISTS "storage";
     DROP TABLE IF EXISTS "sqlite_sequence";
     DROP TABLE IF EXISTS "user_status";
+    DROP TABLE IF EXISTS "storage_archive";
+    DROP TABLE IF EXISTS "code_lease";
+    DROP TABLE IF EXISTS "code_attempt";
 '''
 
 
+# Each item upgrades the schema by one version, tracked by PRAGMA user_version
+_MIGRATE_STATEMENTS_CodeStorage = (
+    '''
+    CREATE INDEX IF NOT EXISTS "storage_live" ON "storage" ("id") WHERE "FR" = 0 AND "other" = 0;
+    ''',
+    # Codes inserted before upgrade are treated as inserted now
+    '''
+    ALTER TABLE "storage" ADD COLUMN "created_at" INTEGER NOT NULL DEFAULT 0;
+    UPDATE "storage" SET "created_at" = CAST(strftime('%s', 'now') AS INTEGER);
+    CREATE TABLE IF NOT EXISTS "storage_archive" (
+        "code"  TEXT NOT NULL PRIMARY KEY,
+        "id"    INTEGER NOT NULL,
+        "FR"    INTEGER NOT NULL,
+        "other" INTEGER NOT NULL,
+        "created_at"    INTEGER NOT NULL,
+        "archived_at"   INTEGER NOT NULL
+    );
+    ''',
+    # Exclusive assignment: code held by a user until expires_at, and codes each user has tried
+    '''
+    CREATE TABLE IF NOT EXISTS "code_lease" (
+        "code_id"       INTEGER NOT NULL PRIMARY KEY,
+        "user_id"       TEXT NOT NULL,
+        "expires_at"    REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS "code_attempt" (
+        "user_id"   TEXT NOT NULL,
+        "code_id"   INTEGER NOT NULL,
+        PRIMARY KEY ("user_id", "code_id")
+    ) WITHOUT ROWID;
+    ''',
+    # Recording an attempt releases lease of that user, so completing a lease is a single statement
+    '''
+    CREATE TRIGGER IF NOT EXISTS "code_attempt_release" AFTER INSERT ON "code_attempt"
+    BEGIN
+        DELETE FROM "code_lease" WHERE "code_id" = NEW."code_id" AND "user_id" = NEW."user_id";
+    END;
+    ''',
+)
+
+_ASSIGN_STATEMENT = '''
+    INSERT INTO "user_status" ("user_id", "index")
+    SELECT ?1, "id" FROM "storage"
+    WHERE "id" > COALESCE((SELECT "index" FROM "user_status" WHERE "user_id" = ?1), 0)
+        AND "FR" = 0 AND "other" = 0
+    ORDER BY "id" ASC LIMIT 1
+    ON CONFLICT ("user_id") DO UPDATE SET "index" = excluded."index"
+    RETURNING (SELECT "code" FROM "storage" WHERE "storage"."id" = "index")
+'''
+
+# Oldest live code not tried by user and not held by anyone else, expired lease is taken over
+_LEASE_CANDIDATE = '''
+    SELECT "id" FROM "storage"
+    WHERE "FR" = 0 AND "other" = 0
+        AND NOT EXISTS (SELECT 1 FROM "code_attempt" WHERE "user_id" = ?1 AND "code_id" = "storage"."id")
+        AND NOT EXISTS (SELECT 1 FROM "code_lease" WHERE "code_id" = "storage"."id" AND "expires_at" > ?3)
+    ORDER BY "id" ASC LIMIT 1
+'''
+
+_LEASE_STATEMENT = f'''
+    INSERT INTO "code_lease" ("code_id", "user_id", "expires_at")
+    SELECT "id", ?1, ?2 FROM ({_LEASE_CANDIDATE}) WHERE true
+    ON CONFLICT ("code_id") DO UPDATE SET "user_id" = excluded."user_id", "expires_at" = excluded."expires_at"
+    RETURNING (SELECT "code" FROM "storage" WHERE "storage"."id" = "code_id")
+'''
+
+_INSERT_STATEMENT = '''
+    INSERT OR IGNORE INTO "storage" ("code", "created_at")
+    SELECT ?1, CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE NOT EXISTS (SELECT 1 FROM "storage_archive" WHERE "code" = ?1)
+'''
+
+_BATCH_INSERT_STATEMENT = '''
+    INSERT OR IGNORE INTO "storage" ("code", "created_at")
+    SELECT "value", CAST(strftime('%s', 'now') AS INTEGER) FROM json_each(?)
+    WHERE "value" NOT IN (SELECT "code" FROM "storage_archive") ORDER BY "key"
+    RETURNING "code"
+'''
+
+# Dead codes are marked ones, and ones inserted before cutoff
+_COMPACT_SELECT_STATEMENT = '''
+    SELECT "id", "code" FROM "storage"
+    WHERE "id" > ? AND ("FR" != 0 OR "other" != 0 OR "created_at" < ?)
+    ORDER BY "id" ASC LIMIT ?
+'''
+
+# RETURNING clause requires SQLite 3.35.0
+_SUPPORT_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_PRAGMA_STATEMENT = '''
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -8192;
+    PRAGMA busy_timeout = 5000;
+'''
+
+
+class InsertResult(NamedTuple):
+    inserted: List[str]
+    duplicated: List[str]
+
+
+class ConnectionPool:
+    """Long-lived connections: one writer and a pool of readers, all in WAL mode"""
+
+    def __init__(self, file_name: str, readers: int = 4):
+        self.file_name = file_name
+        self.reader_count = max(readers, 1)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle_readers: 'asyncio.Queue[aiosqlite.Connection]' = asyncio.Queue()
+        self.on_wait: Optional[Callable[[float], None]] = None
+
+    async def _connect(self, *, query_only: bool = False) -> aiosqlite.Connection:
+        # Autocommit, so a statement never joins a transaction left open by another coroutine,
+        # statements which must be atomic together are wrapped in BEGIN IMMEDIATE explicitly
+        db = await aiosqlite.connect(self.file_name, isolation_level=None)
+        await db.executescript(_PRAGMA_STATEMENT)
+        if query_only:
+            await db.execute('PRAGMA query_only = ON')
+        return db
+
+    async def open(self) -> None:
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            db = await self._connect(query_only=True)
+            self._readers.append(db)
+            self._idle_readers.put_nowait(db)
+
+    @property
+    def writer(self) -> aiosqlite.Connection:
+        if self._writer is None:
+            raise RuntimeError('Connection pool is not opened')
+        return self._writer
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        start = time.perf_counter()
+        db = await self._idle_readers.get()
+        if self.on_wait is not None:
+            self.on_wait(time.perf_counter() - start)
+        try:
+            yield db
+        finally:
+            self._idle_readers.put_nowait(db)
+
+    async def close(self) -> None:
+        for db in self._readers:
+            await db.close()
+        self._readers.clear()
+        self._idle_readers = asyncio.Queue()
+        if self._writer is not None:
+            # Refresh query planner statistics, closing the last connection also checkpoints the WAL
+            await self._writer.execute('PRAGMA optimize')
+            await self._writer.close()
+            self._writer = None
+
+
+class WriteBehindBuffer:
+    """Keyed write-behind buffer, later value of same key overrides the earlier one, flushed by size or time"""
+
+    def __init__(self, writer: Callable[[List[Tuple]], Awaitable[None]], max_size: int = 256, interval: float = 1.0):
+        self.writer = writer
+        self.max_size = max_size
+        self.interval = interval
+        self.pending: Dict[str, Tuple] = {}
+        # Items taken by a flush, until it is committed
+        self.inflight: Dict[str, Tuple] = {}
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, key: str, value: Tuple) -> None:
+        self.pending[key] = value
+        if len(self.pending) >= self.max_size:
+            self._full.set()
+
+    def get(self, key: str) -> Optional[Tuple]:
+        """Latest value not committed yet"""
+        if key in self.pending:
+            return self.pending[key]
+        return self.inflight.get(key)
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.inflight.update(pending)
+        try:
+            await self.writer([(key, *value) for key, value in pending.items()])
+        except BaseException as e:
+            # Transaction is rolled back, keep items for the next flush, newer values put meanwhile win
+            for key, value in pending.items():
+                self.pending.setdefault(key, value)
+            if not isinstance(e, Exception):
+                raise
+            logger.exception('Got exception while flush %d item(s), retry later', len(pending))
+        finally:
+            for key, value in pending.items():
+                if self.inflight.get(key) is value:
+                    del self.inflight[key]
+
+    async def _flush_loop(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        # Let a running flush finish, cancelling it would roll back the items it took
+        self._stopping = True
+        self._full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+class MarkBuffer(WriteBehindBuffer):
+    def mark(self, code: str, is_fr: bool, other: bool) -> None:
+        self.put(code.lower(), (int(is_fr), int(other)))
+
+    def is_dead(self, code: str) -> bool:
+        return any(self.get(code) or ())
+
+
 class CodeStorage(SqliteBase):
+    """
+    Writer connection is in autocommit mode and most writes are a single statement, which is atomic by itself,
+    so writers are serialized by the connection thread rather than a lock, and readers never wait for them
+    in WAL mode. Writes of several statements run in `_transaction`, which holds `self.lock`, single statements
+    issued meanwhile wait for it in `_writing`. Statements with RETURNING clause must be consumed by
+    `execute_fetchall`, so that the statement is finished before the next one starts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ConnectionPool(self.file_name)
+        self.pool.on_wait = lambda seconds: self._report_wait('reader', seconds)
+        self.mark_buffer: Optional[MarkBuffer] = None
+        self._compact_from = 0
+        # Called with (kind, seconds) after waiting for lock or reader connection
+        self.on_lock_wait: Optional[Callable[[str, float], None]] = None
+        # Called with seconds the lock was held
+        self.on_lock_held: Optional[Callable[[float], None]] = None
+
+    def _report_wait(self, kind: str, seconds: float) -> None:
+        if self.on_lock_wait is not None:
+            self.on_lock_wait(kind, seconds)
+
+    @asynccontextmanager
+    async def _locked(self) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        async with self.lock:
+            acquired = time.perf_counter()
+            self._report_wait('lock', acquired - start)
+            try:
+                yield
+            finally:
+                if self.on_lock_held is not None:
+                    self.on_lock_held(time.perf_counter() - acquired)
+
+    @asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        BEGIN IMMEDIATE takes database write lock up front, so writers of other processes wait
+        for busy_timeout instead of failing in the middle of our statements
+        """
+        async with self._locked():
+            db = self.pool.writer
+            await db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                await db.rollback()
+                raise
+            await db.commit()
+
+    @asynccontextmanager
+    async def _writing(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Writer connection for a single statement, which must not land inside a transaction of another coroutine"""
+        if self.lock.locked():
+            async with self._locked():
+                yield self.pool.writer
+        else:
+            yield self.pool.writer
+
     @classmethod
-    async def new(cls, file_name: str, *, renew: bool = False) -> 'CodeStorage':
-        return await cls._new(file_name, _DROP_STATEMENT_CodeStorage, _CREATE_STATEMENT_CodeStorage,
+    async def new(cls, file_name: str, *, renew: bool = False, readers: int = 4,
+                  write_behind: bool = False, write_behind_size: int = 256,
+                  write_behind_interval: float = 1.0) -> 'CodeStorage':
+        self = await cls._new(file_name, _DROP_STATEMENT_CodeStorage, _CREATE_STATEMENT_CodeStorage,
                               main_table_name='storage', renew=renew)
+        self.pool.reader_count = max(readers, 1)
+        await self.pool.open()
+        await self.migrate(renew)
+        if write_behind:
+            self.mark_buffer = MarkBuffer(self._write_marks, write_behind_size, write_behind_interval)
+            self.mark_buffer.start()
+        return self
+
+    async def migrate(self, renew: bool = False) -> None:
+        async with self._locked():
+            db = self.pool.writer
+            if renew:
+                await db.execute('PRAGMA user_version = 0')
+            async with db.execute('PRAGMA user_version') as cursor:
+                version, = await cursor.fetchone()
+            for statement in _MIGRATE_STATEMENTS_CodeStorage[version:]:
+                version += 1
+                # executescript commits before running, so transaction is part of the script
+                await db.executescript(f'BEGIN IMMEDIATE; {statement} PRAGMA user_version = {version}; COMMIT;')
+                logger.info('Migrated database schema to version %d', version)
+
+    async def close(self) -> None:
+        if self.mark_buffer is not None:
+            await self.mark_buffer.close()
+        await self.pool.close()
 
     async def insert_code(self, code: str) -> bool:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''SELECT * FROM "storage" WHERE "code" = ? ''', (code.lower(),)) as cursor:
-                if await cursor.fetchone() is not None:
-                    return False
-            async with db.execute('''INSERT INTO "storage" ("code") VALUES (?)''', (code.lower(),)):
-                pass
-            await db.commit()
-            return True
+        async with self._writing() as db:
+            async with db.execute(_INSERT_STATEMENT, (code.lower(),)) as cursor:
+                return cursor.rowcount == 1
+
+    async def insert_codes(self, codes: Iterable[str], *, chunk_size: int = 500) -> InsertResult:
+        codes = [code.lower() for code in codes]
+        candidate = list(dict.fromkeys(codes))
+        if not candidate:
+            return InsertResult([], codes)
+        if _SUPPORT_RETURNING:
+            # Single statement is atomic, so concurrent writers need not to be locked out
+            async with self._writing() as db:
+                rows = await db.execute_fetchall(_BATCH_INSERT_STATEMENT, (json.dumps(candidate),))
+            created = {row[0] for row in rows}
+            inserted = [code for code in candidate if code in created]
+        else:
+            inserted = await self._insert_codes_fallback(candidate, chunk_size)
+        # Report in-batch repeats as duplicated too
+        pending = set(inserted)
+        duplicated = []
+        for code in codes:
+            if code in pending:
+                pending.discard(code)
+            else:
+                duplicated.append(code)
+        return InsertResult(inserted, duplicated)
+
+    async def _insert_codes_fallback(self, candidate: List[str], chunk_size: int) -> List[str]:
+        existing = set()
+        async with self._transaction() as db:
+            for offset in range(0, len(candidate), chunk_size):
+                chunk = candidate[offset:offset + chunk_size]
+                placeholders = ', '.join('?' * len(chunk))
+                async with db.execute(f'''SELECT "code" FROM "storage" WHERE "code" IN ({placeholders})
+                                      UNION SELECT "code" FROM "storage_archive" WHERE "code" IN ({placeholders})''',
+                                      chunk * 2) as cursor:
+                    existing.update(row[0] for row in await cursor.fetchall())
+            inserted = [code for code in candidate if code not in existing]
+            if inserted:
+                await db.executemany('''INSERT OR IGNORE INTO "storage" ("code", "created_at")
+                                     VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))''',
+                                     [(code,) for code in inserted])
+        return inserted
+
+    async def latest_code_id(self) -> int:
+        async with self.pool.reader() as db:
+            async with db.execute('''SELECT MAX("id") FROM "storage"''') as cursor:
+                obj = await cursor.fetchone()
+        return obj[0] or 0
+
+    async def fetch_recent_codes(self, limit: int) -> List[str]:
+        async with self.pool.reader() as db:
+            async with db.execute('''SELECT "code" FROM "storage" ORDER BY "id" DESC LIMIT ?''', (limit,)) as cursor:
+                return [row[0] for row in reversed(await cursor.fetchall())]
+
+    async def compact_step(self, ttl: float = 0, step: int = 500) -> List[str]:
+        """
+        Move next `step` dead codes to archive table, return codes moved. Empty list means
+        the scan reached the end, and next call starts over from beginning.
+        Ids are never reused, so user cursors stay valid.
+        """
+        cutoff = int(time.time() - ttl) if ttl > 0 else 0
+        async with self.pool.reader() as reader:
+            rows = await reader.execute_fetchall(_COMPACT_SELECT_STATEMENT, (self._compact_from, cutoff, step))
+        if not rows:
+            self._compact_from = 0
+            return []
+        self._compact_from = rows[-1][0]
+        code_ids = [row[0] for row in rows]
+        placeholders = ', '.join('?' * len(code_ids))
+        condition = f'''"id" IN ({placeholders}) AND ("FR" != 0 OR "other" != 0 OR "created_at" < ?)'''
+        async with self._transaction() as db:
+            await db.execute_fetchall(f'''
+                INSERT OR IGNORE INTO "storage_archive"
+                SELECT "code", "id", "FR", "other", "created_at", CAST(strftime('%s', 'now') AS INTEGER)
+                FROM "storage" WHERE {condition}''', (*code_ids, cutoff))
+            await db.execute_fetchall(f'''DELETE FROM "storage" WHERE {condition}''', (*code_ids, cutoff))
+            for table in ('code_lease', 'code_attempt'):
+                await db.execute_fetchall(f'''DELETE FROM "{table}" WHERE "code_id" IN ({placeholders})
+                                          AND "code_id" NOT IN (SELECT "id" FROM "storage")''', code_ids)
+        return [row[1] for row in rows]
 
     async def delete_code(self, code: str) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''DELETE FROM "storage" WHERE "code" = ?''', (code.lower(),)):
-                pass
-            await db.commit()
+        async with self._writing() as db:
+            await db.execute_fetchall('''DELETE FROM "storage" WHERE "code" = ?''', (code.lower(),))
 
     async def mark_code(self, code: str, is_fr: bool, other: bool = False) -> None:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
-            async with db.execute('''UPDATE "storage" SET "FR" = ?, "other" = ? WHERE "code" = ?''',
-                                  (code.lower(), int(is_fr), int(other))):
-                pass
-            await db.commit()
+        if self.mark_buffer is not None:
+            self.mark_buffer.mark(code, is_fr, other)
+            return
+        await self._write_marks([(code.lower(), int(is_fr), int(other))])
+
+    async def mark_codes(self, marks: Iterable[Tuple[str, bool, bool]]) -> None:
+        """Mark several codes in one write, items are (code, FR, other)"""
+        marks = [(code.lower(), int(is_fr), int(other)) for code, is_fr, other in marks]
+        if self.mark_buffer is not None:
+            for code, is_fr, other in marks:
+                self.mark_buffer.mark(code, is_fr, other)
+            return
+        if marks:
+            await self._write_marks(marks)
+
+    async def _write_marks(self, marks: List[Tuple[str, int, int]]) -> None:
+        async with self._transaction() as db:
+            await db.executemany('''UPDATE "storage" SET "FR" = ?, "other" = ? WHERE "code" = ?''',
+                                 [(is_fr, other, code) for code, is_fr, other in marks])
 
     @staticmethod
     async def update_user_index(db: aiosqlite.Connection, user: str, index: int, insert: bool = False) -> None:
@@ -83,35 +502,291 @@ class CodeStorage(SqliteBase):
         else:
             async with db.execute('''UPDATE "user_status" SET "index" = ? WHERE "user_id" = ?''', (index, user)):
                 pass
-        await db.commit()
 
     async def request_next_code(self, user: str) -> Optional[str]:
-        async with self.lock, aiosqlite.connect(self.file_name) as db:
+        while True:
+            code = await self._assign_next_code(user)
+            # Skip codes marked but not flushed yet, cursor has moved past them already
+            if code is None or self.mark_buffer is None or not self.mark_buffer.is_dead(code):
+                return code
+
+    async def _assign_next_code(self, user: str) -> Optional[str]:
+        if not _SUPPORT_RETURNING:
+            return await self._request_next_code_fallback(user)
+        async with self._writing() as db:
+            rows = await db.execute_fetchall(_ASSIGN_STATEMENT, (user,))
+        return rows[0][0] if rows else None
+
+    async def request_next_codes(self, user: str, count: int) -> List[str]:
+        while True:
+            async with self.pool.reader() as reader:
+                rows = await reader.execute_fetchall('''
+                    SELECT "id", "code" FROM "storage"
+                    WHERE "id" > COALESCE((SELECT "index" FROM "user_status" WHERE "user_id" = ?), 0)
+                        AND "FR" = 0 AND "other" = 0
+                    ORDER BY "id" ASC LIMIT ?''', (user, count))
+            if not rows:
+                return []
+            # Never move cursor backwards, in case the same user is served by another connection meanwhile
+            async with self._writing() as db:
+                await db.execute_fetchall('''
+                    INSERT INTO "user_status" ("user_id", "index") VALUES (?, ?)
+                    ON CONFLICT ("user_id") DO UPDATE SET "index" = MAX("index", excluded."index")''',
+                                          (user, rows[-1][0]))
+            codes = [code for _, code in rows if self.mark_buffer is None or not self.mark_buffer.is_dead(code)]
+            if codes:
+                return codes
+
+    async def assign_code(self, code: str, users: List[str]) -> None:
+        """Move cursors of users to a code handed out by server, in one write"""
+        async with self._transaction() as db:
+            await db.executemany('''INSERT INTO "user_status" ("user_id", "index")
+                                 SELECT ?, "id" FROM "storage" WHERE "code" = ?
+                                 ON CONFLICT ("user_id") DO UPDATE SET "index" = MAX("index", excluded."index")''',
+                                 [(user, code.lower()) for user in users])
+
+    async def lease_next_code(self, user: str, timeout: float) -> Optional[str]:
+        """Hold oldest code not tried by user for `timeout` seconds, nobody else gets it meanwhile"""
+        while True:
+            code = await self._lease_next_code(user, timeout)
+            if code is None or self.mark_buffer is None or not self.mark_buffer.is_dead(code):
+                return code
+            # Marked but not flushed yet, record as tried so it is skipped
+            await self.complete_lease(user, code)
+
+    async def _lease_next_code(self, user: str, timeout: float) -> Optional[str]:
+        now = time.time()
+        if _SUPPORT_RETURNING:
+            async with self._writing() as db:
+                rows = await db.execute_fetchall(_LEASE_STATEMENT, (user, now + timeout, now))
+            return rows[0][0] if rows else None
+        # Read on writer inside transaction, so no other process takes the candidate meanwhile
+        async with self._transaction() as db:
+            rows = await db.execute_fetchall(f'''SELECT "id", "code" FROM "storage" WHERE "id" = (
+                                             {_LEASE_CANDIDATE})''', (user, None, now))
+            if not rows:
+                return None
+            await db.execute_fetchall('''INSERT OR REPLACE INTO "code_lease" VALUES (?, ?, ?)''',
+                                      (rows[0][0], user, now + timeout))
+            return rows[0][1]
+
+    async def complete_lease(self, user: str, code: str) -> None:
+        """User has tried the code, pass it on to users who have not"""
+        # Lease is deleted by trigger, REPLACE fires it even when the attempt was recorded before
+        async with self._writing() as db:
+            await db.execute_fetchall('''INSERT OR REPLACE INTO "code_attempt"
+                                      SELECT ?, "id" FROM "storage" WHERE "code" = ?''', (user, code.lower()))
+
+    async def release_lease(self, user: str, code: str) -> None:
+        """User gave up the code without trying it, e.g. disconnected"""
+        async with self._writing() as db:
+            await db.execute_fetchall('''DELETE FROM "code_lease" WHERE "user_id" = ? AND "code_id" =
+                                      (SELECT "id" FROM "storage" WHERE "code" = ?)''', (user, code.lower()))
+
+    async def _request_next_code_fallback(self, user: str) -> Optional[str]:
+        # Read on writer inside transaction, so cursor is not moved by another process meanwhile
+        async with self._transaction() as db:
             async with db.execute('''SELECT "index" FROM "user_status" WHERE "user_id" = ?''', (user,)) as cursor:
                 obj = await cursor.fetchone()
+            insert = obj is None
+            current_num = 0 if insert else obj[0]
+            async with db.execute('''
+            SELECT "code", "id" FROM "storage"
+            WHERE "id" > ? AND "FR" = 0 AND "other" = 0
+            ORDER BY "id" ASC LIMIT 1''', (current_num,)) as cursor:
+                obj = await cursor.fetchone()
                 if obj is None:
-                    async with db.execute('''
-                    SELECT "code", "id" FROM "storage"
-                    WHERE "FR" = 0 AND "other" = 0
-                    ORDER BY "id" ASC LIMIT 1''') as cursor1:
-                        obj = await cursor1.fetchone()
-                        if obj is None:
-                            return None
-                        passcode, current_num = obj
-                    await self.update_user_index(db, user, current_num, True)
-                else:
-                    current_num = obj[0]
-                    async with db.execute('''
-                    SELECT "code", "id" FROM "storage"
-                    WHERE "id" > ? AND "FR" = 0 AND "other" = 0
-                    ORDER BY "id" ASC LIMIT 1''',
-                                          (current_num,)) as cursor1:
-                        obj = await cursor1.fetchone()
-                        if obj is None:
-                            return None
-                        passcode, current_num = obj
-                    await self.update_user_index(db, user, current_num)
+                    return None
+                passcode, current_num = obj
+            await self.update_user_index(db, user, current_num, insert)
             return passcode
 
     async def update_user_status(self, user: str) -> None:
         pass
+
+
+class MemoryCodeStorage(CodeStorage):
+    """
+    Keep live code ids in a sorted array and user cursors in memory, so a handout is a bisect.
+    SQLite stays the durable backing store: code changes are written through, cursors are written behind.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.live_ids = array('q')
+        self.codes: Dict[int, str] = {}
+        self.ids: Dict[str, int] = {}
+        self.cursors: Dict[str, int] = {}
+        self.cursor_buffer = WriteBehindBuffer(self._write_cursors)
+
+    @classmethod
+    async def new(cls, file_name: str, *, state: Optional[Tuple[List[int], Dict[str, Any]]] = None,
+                  **kwargs) -> 'MemoryCodeStorage':
+        self = await super().new(file_name, **kwargs)
+        if state is None or not await self.restore(*state):
+            await self.load()
+        self.cursor_buffer.start()
+        return self
+
+    async def fingerprint(self) -> Tuple[int, ...]:
+        rows = await self.pool.writer.execute_fetchall('''SELECT
+            (SELECT COALESCE(MAX("id"), 0) FROM "storage"),
+            (SELECT COUNT(*) FROM "storage"),
+            (SELECT COUNT(*) FROM "storage" WHERE "FR" = 0 AND "other" = 0),
+            (SELECT COUNT(*) FROM "user_status"),
+            (SELECT COALESCE(SUM("index"), 0) FROM "user_status")''')
+        return tuple(rows[0])
+
+    def memory_fingerprint(self) -> Tuple[int, ...]:
+        """Same as `fingerprint` once buffers are flushed"""
+        return (max(self.codes, default=0), len(self.codes), len(self.live_ids), len(self.cursors),
+                sum(self.cursors.values()))
+
+    def export_state(self) -> Dict[str, Any]:
+        return {
+            'ids': base64.b64encode(array('q', self.codes).tobytes()).decode(),
+            'codes': '\n'.join(self.codes.values()),
+            'live': base64.b64encode(self.live_ids.tobytes()).decode(),
+            'cursors': dict(self.cursors),
+        }
+
+    async def restore(self, fingerprint: List[int], state: Dict[str, Any]) -> bool:
+        if list(await self.fingerprint()) != fingerprint:
+            logger.info('Snapshot does not match database, load from database')
+            return False
+        ids = array('q')
+        ids.frombytes(base64.b64decode(state['ids']))
+        codes = state['codes'].split('\n') if state['codes'] else []
+        self.codes = dict(zip(ids, codes))
+        self.ids = dict(zip(codes, ids))
+        self.live_ids = array('q')
+        self.live_ids.frombytes(base64.b64decode(state['live']))
+        self.cursors = dict(state['cursors'])
+        logger.info('Restored %d live code(s) of %d and %d cursor(s) from snapshot',
+                    len(self.live_ids), len(self.codes), len(self.cursors))
+        return True
+
+    async def flush(self) -> None:
+        await self.cursor_buffer.flush()
+        if self.mark_buffer is not None:
+            await self.mark_buffer.flush()
+
+    async def load(self) -> None:
+        db = self.pool.writer
+        self.live_ids = array('q')
+        self.codes.clear()
+        self.ids.clear()
+        for code_id, code, is_fr, other in await db.execute_fetchall(
+                '''SELECT "id", "code", "FR", "other" FROM "storage" ORDER BY "id" ASC'''):
+            self.codes[code_id] = code
+            self.ids[code] = code_id
+            if not is_fr and not other:
+                self.live_ids.append(code_id)
+        self.cursors = dict(await db.execute_fetchall('''SELECT "user_id", "index" FROM "user_status"'''))
+        logger.info('Loaded %d live code(s) of %d and %d cursor(s) to memory',
+                    len(self.live_ids), len(self.codes), len(self.cursors))
+
+    async def close(self) -> None:
+        await self.cursor_buffer.close()
+        await super().close()
+
+    def _add_live(self, code_id: int) -> None:
+        if not self.live_ids or self.live_ids[-1] < code_id:
+            self.live_ids.append(code_id)
+            return
+        pos = bisect_left(self.live_ids, code_id)
+        if pos == len(self.live_ids) or self.live_ids[pos] != code_id:
+            insort(self.live_ids, code_id)
+
+    def _remove_live(self, code_id: int) -> None:
+        pos = bisect_left(self.live_ids, code_id)
+        if pos < len(self.live_ids) and self.live_ids[pos] == code_id:
+            del self.live_ids[pos]
+
+    async def _track_codes(self, codes: List[str], chunk_size: int = 500) -> None:
+        db = self.pool.writer
+        for offset in range(0, len(codes), chunk_size):
+            chunk = codes[offset:offset + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            for code_id, code in await db.execute_fetchall(
+                    f'''SELECT "id", "code" FROM "storage" WHERE "code" IN ({placeholders})''', chunk):
+                self.codes[code_id] = code
+                self.ids[code] = code_id
+                self._add_live(code_id)
+
+    async def insert_code(self, code: str) -> bool:
+        if await super().insert_code(code):
+            await self._track_codes([code.lower()])
+            return True
+        return False
+
+    async def insert_codes(self, codes: Iterable[str], *, chunk_size: int = 500) -> InsertResult:
+        result = await super().insert_codes(codes, chunk_size=chunk_size)
+        await self._track_codes(result.inserted, chunk_size)
+        return result
+
+    async def delete_code(self, code: str) -> None:
+        code_id = self.ids.pop(code.lower(), None)
+        if code_id is not None:
+            self.codes.pop(code_id, None)
+            self._remove_live(code_id)
+        await super().delete_code(code)
+
+    def _mark_live(self, code: str, is_fr: bool, other: bool) -> None:
+        code_id = self.ids.get(code.lower())
+        if code_id is not None:
+            if is_fr or other:
+                self._remove_live(code_id)
+            else:
+                self._add_live(code_id)
+
+    async def mark_code(self, code: str, is_fr: bool, other: bool = False) -> None:
+        self._mark_live(code, is_fr, other)
+        await super().mark_code(code, is_fr, other)
+
+    async def mark_codes(self, marks: Iterable[Tuple[str, bool, bool]]) -> None:
+        marks = list(marks)
+        for mark in marks:
+            self._mark_live(*mark)
+        await super().mark_codes(marks)
+
+    async def request_next_code(self, user: str) -> Optional[str]:
+        pos = bisect_right(self.live_ids, self.cursors.get(user, 0))
+        if pos == len(self.live_ids):
+            return None
+        code_id = self.live_ids[pos]
+        self.cursors[user] = code_id
+        self.cursor_buffer.put(user, (code_id,))
+        return self.codes[code_id]
+
+    async def request_next_codes(self, user: str, count: int) -> List[str]:
+        pos = bisect_right(self.live_ids, self.cursors.get(user, 0))
+        code_ids = self.live_ids[pos:pos + count]
+        if not code_ids:
+            return []
+        self.cursors[user] = code_ids[-1]
+        self.cursor_buffer.put(user, (code_ids[-1],))
+        return [self.codes[code_id] for code_id in code_ids]
+
+    async def assign_code(self, code: str, users: List[str]) -> None:
+        code_id = self.ids.get(code.lower())
+        if code_id is None:
+            return
+        for user in users:
+            if self.cursors.get(user, 0) < code_id:
+                self.cursors[user] = code_id
+                self.cursor_buffer.put(user, (code_id,))
+
+    async def compact_step(self, ttl: float = 0, step: int = 500) -> List[str]:
+        codes = await super().compact_step(ttl, step)
+        for code in codes:
+            code_id = self.ids.pop(code, None)
+            if code_id is not None:
+                self.codes.pop(code_id, None)
+                self._remove_live(code_id)
+        return codes
+
+    async def _write_cursors(self, cursors: List[Tuple[str, int]]) -> None:
+        async with self._transaction() as db:
+            await db.executemany('''INSERT INTO "user_status" ("user_id", "index") VALUES (?, ?)
+                                 ON CONFLICT ("user_id") DO UPDATE SET "index" = excluded."index"''', cursors)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# libstorage.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import logging
+from configparser import ConfigParser
+from typing import Any, Callable, Dict, Iterable, List, Optional, Protocol, Tuple
+
+from libsqlite import CodeStorage, InsertResult, MarkBuffer, MemoryCodeStorage
+
+logger = logging.getLogger("code_master").getChild("storage")
+logger.setLevel(logging.getLogger("code_master").level)
+
+
+class CodeStorageBackend(Protocol):
+    """Interface of code storage used by web server"""
+    mark_buffer: Optional[MarkBuffer]
+    on_lock_wait: Optional[Callable[[str, float], None]]
+    on_lock_held: Optional[Callable[[float], None]]
+
+    async def close(self) -> None: ...
+
+    async def insert_code(self, code: str) -> bool: ...
+
+    async def insert_codes(self, codes: Iterable[str]) -> InsertResult: ...
+
+    async def delete_code(self, code: str) -> None: ...
+
+    async def mark_code(self, code: str, is_fr: bool, other: bool = False) -> None: ...
+
+    async def mark_codes(self, marks: Iterable[Tuple[str, bool, bool]]) -> None: ...
+
+    async def request_next_code(self, user: str) -> Optional[str]: ...
+
+    async def request_next_codes(self, user: str, count: int) -> List[str]: ...
+
+    async def assign_code(self, code: str, users: List[str]) -> None: ...
+
+    async def lease_next_code(self, user: str, timeout: float) -> Optional[str]: ...
+
+    async def complete_lease(self, user: str, code: str) -> None: ...
+
+    async def release_lease(self, user: str, code: str) -> None: ...
+
+    async def fetch_recent_codes(self, limit: int) -> List[str]: ...
+
+    async def latest_code_id(self) -> int: ...
+
+    async def compact_step(self, ttl: float = 0, step: int = 500) -> List[str]: ...
+
+
+async def open_storage(config: ConfigParser, *, renew: bool = False, multi_process: bool = False,
+                       state: Optional[Tuple[List[int], Dict[str, Any]]] = None) -> CodeStorageBackend:
+    engine = config.get('storage', 'engine', fallback='sqlite')
+    if engine == 'redis':
+        # Import here, so aioredis is only required when redis engine is selected
+        from libredis import RedisCodeStorage
+        logger.info('Use redis code storage')
+        return await RedisCodeStorage.new(config.get('storage', 'redis_url', fallback='redis://localhost'),
+                                          prefix=config.get('storage', 'redis_prefix', fallback='codeserver'),
+                                          renew=renew)
+    storage_cls = CodeStorage
+    kwargs = {}
+    if engine == 'memory':
+        if multi_process:
+            logger.warning('In-memory code index can not be shared between workers, use sqlite engine')
+        else:
+            logger.info('Use in-memory code index backed by SQLite')
+            storage_cls = MemoryCodeStorage
+            # Restore in-memory index from snapshot instead of scanning database
+            kwargs['state'] = state
+    elif engine != 'sqlite':
+        raise ValueError(f'Unknown storage engine {engine!r}')
+    return await storage_cls.new(config.get('storage', 'database', fallback='codeserver.db'),
+                                 **kwargs,
+                                 renew=renew,
+                                 readers=config.getint('storage', 'readers', fallback=4),
+                                 write_behind=config.getboolean('storage', 'write_behind', fallback=False),
+                                 write_behind_size=config.getint('storage', 'write_behind_size', fallback=256),
+                                 write_behind_interval=config.getfloat('storage', 'write_behind_interval',
+                                                                       fallback=1.0))
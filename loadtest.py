@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# loadtest.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from collections import Counter
+from configparser import ConfigParser
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from localserver import BINARY_PROTOCOL, WebServer, spawn_workers, stop_workers
+
+logger = logging.getLogger('loadtest')
+
+
+class Statistic:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.codes = 0
+        self.responses: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.finished_clients = 0
+        self.idle_clients = 0
+
+    @staticmethod
+    def percentile(data: List[float], percent: float) -> Optional[float]:
+        if not data:
+            return None
+        return data[min(len(data) - 1, int(len(data) * percent))]
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            'handouts': len(latencies),
+            'codes': self.codes,
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0,
+            'latency': {
+                'p50': self.percentile(latencies, .5),
+                'p90': self.percentile(latencies, .9),
+                'p99': self.percentile(latencies, .99),
+                'max': latencies[-1] if latencies else None,
+            },
+            # Keyed by "status.sub" of server responses, e.g. "400.5" is register timeout
+            'responses': dict(self.responses),
+            'errors': dict(self.errors),
+            'finished_clients': self.finished_clients,
+            'idle_clients': self.idle_clients,
+        }
+
+
+async def run_client(session: aiohttp.ClientSession, url: str, user: str, args: argparse.Namespace,
+                     stat: Statistic, deadline: float) -> None:
+    register = f'register_{args.version}' + (f' {args.password}' if args.password else '') + f' {user}'
+    received = 0
+    request = f'continue {args.prefetch}' if args.prefetch > 1 else 'continue'
+    try:
+        async with session.ws_connect(url, protocols=(BINARY_PROTOCOL,) if args.binary else (),
+                                      compress=15 if args.compress else 0) as ws:
+            requested_at = time.perf_counter()
+            await ws.send_str(register)
+            while received < args.codes:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    stat.errors['deadline'] += 1
+                    break
+                try:
+                    msg = await ws.receive(timeout=min(timeout, args.idle))
+                except asyncio.TimeoutError:
+                    # Codes marked by others are skipped, so a client may never see all seeded codes
+                    if timeout > args.idle:
+                        stat.idle_clients += 1
+                        break
+                    raise
+                if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                    stat.errors[f'ws_{msg.type.name.lower()}'] += 1
+                    return
+                data = json.loads(msg.data)
+                stat.responses[f'{data["status"]}.{data["sub"]}'] += 1
+                if data['status'] != 200:
+                    continue
+                stat.latencies.append(time.perf_counter() - requested_at)
+                codes = data['body'] if data['sub'] == 1 else [data['body']]
+                received += len(codes)
+                stat.codes += len(codes)
+                for code in codes:
+                    if random.random() < args.mark_ratio:
+                        await ws.send_str(random.choice(('FR', 'mark_other')) + (f' {code}' if data['sub'] else ''))
+                requested_at = time.perf_counter()
+                await ws.send_str(request)
+            else:
+                stat.finished_clients += 1
+            await ws.send_str('close')
+    except asyncio.TimeoutError:
+        stat.errors['deadline'] += 1
+    except aiohttp.ClientError as e:
+        stat.errors[type(e).__name__] += 1
+
+
+async def seed_codes(server: WebServer, codes: List[str], burst: int, interval: float) -> None:
+    for offset in range(0, len(codes), burst):
+        for code in codes[offset:offset + burst]:
+            await server.put_passcode(code)
+        await asyncio.sleep(interval)
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    server = None
+    workers = []
+    url = args.url
+    codes = [f'{args.prefix}{num:08d}' for num in range(args.codes)]
+    if url is None:
+        # Start server same as `./bootstrap.py --nbot`
+        config = ConfigParser()
+        if not config.read(args.config):
+            config.read('config.ini.default')
+        server = await WebServer.load_from_cfg(config)
+        workers = spawn_workers(args.config, config.getint('web', 'workers', fallback=1) - 1)
+        await server.start()
+        url = f'http://{server.bind}:{server.port}{server.ws_prefix}'
+        if not args.trickle:
+            await seed_codes(server, codes, len(codes) or 1, 0)
+    stat = Statistic()
+    deadline = time.monotonic() + args.duration
+    connector = aiohttp.TCPConnector(limit=0)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        clients = []
+        for num in range(args.clients):
+            clients.append(asyncio.create_task(run_client(session, url, f'{args.prefix}user{num}', args, stat,
+                                                          deadline)))
+            if args.ramp and num % args.ramp == args.ramp - 1:
+                await asyncio.sleep(0)
+        if server is not None and args.trickle:
+            await seed_codes(server, codes, args.burst, args.interval)
+        await asyncio.gather(*clients)
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        await server.stop()
+        stop_workers(workers)
+    result = stat.summary(elapsed)
+    result['parameters'] = {key: value for key, value in vars(args).items() if key != 'password'}
+    result['python'] = platform.python_version()
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('receiver.website').setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description='Load generator speaking the code server websocket protocol')
+    parser.add_argument('--url', help='Target an already running server (e.g. ws://127.0.0.1:29985/ws), '
+                                      'codes must be seeded by yourself. Default start a server from --config')
+    parser.add_argument('--config', default='config.ini', help='Configure file of in-process server')
+    parser.add_argument('--clients', type=int, default=1000, help='Simulated clients')
+    parser.add_argument('--codes', type=int, default=20, help='Codes seeded, every client waits for all of them')
+    parser.add_argument('--duration', type=float, default=60, help='Give up after this many seconds')
+    parser.add_argument('--trickle', action='store_true', help='Seed codes while clients running instead of before')
+    parser.add_argument('--burst', type=int, default=5, help='Codes seeded each time in trickle mode')
+    parser.add_argument('--interval', type=float, default=.5, help='Seconds between bursts in trickle mode')
+    parser.add_argument('--mark-ratio', type=float, default=0, help='Chance of sending FR/mark_other after a code')
+    parser.add_argument('--idle', type=float, default=5, help='Client stops after waiting this many seconds for code')
+    parser.add_argument('--ramp', type=int, default=100, help='Yield to event loop every this many connects')
+    parser.add_argument('--prefix', default=f'load{int(time.time())}', help='Prefix of seeded codes and user ids')
+    parser.add_argument('--prefetch', type=int, default=1, help='Request this many codes per `continue N`, '
+                                                                'implies --version of WebServer.prefetch_version')
+    parser.add_argument('--version', help='Script version sent in register')
+    parser.add_argument('--binary', action='store_true', help='Request responses in binary frames')
+    parser.add_argument('--compress', action='store_true', help='Offer permessage-deflate to server')
+    parser.add_argument('--password', default='', help='Register password if server enabled auth')
+    parser.add_argument('--output', help='Write JSON result to file instead of stdout')
+    _args = parser.parse_args()
+    if _args.version is None:
+        _args.version = WebServer.prefetch_version if _args.prefetch > 1 else WebServer.minimum_version
+    result = asyncio.run(main(_args))
+    if result['parameters']['output']:
+        with open(result['parameters']['output'], 'w') as fout:
+            json.dump(result, fout, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
@@ -16,82 +16,573 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 import asyncio
-import concurrent.futures
 import logging
 import hashlib
+import hmac
+import json
+import math
+import multiprocessing
 import os
 import signal
 import ssl
 import time
 import weakref
+from collections import OrderedDict, deque
 from configparser import ConfigParser
-from queue import Queue
-from typing import Dict, NoReturn, Optional, Union
+from typing import (Any, Callable, Coroutine, Deque, Dict, Hashable, Iterable, List, NoReturn, Optional, Set, Tuple,
+                    Union)
 from types import FrameType
 
 import aiohttp
 from aiohttp import web
 
-from libsqlite import CodeStorage
+from libmetrics import Counter, Gauge, Histogram, Registry
+from libprofile import Profiler
+from libsnapshot import Snapshot
+from libsqlite import InsertResult
+from libstorage import CodeStorageBackend, open_storage
 
 logger = logging.getLogger('receiver.website')
 logger.setLevel(logging.DEBUG)
 
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ModuleNotFoundError:
+    def json_dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(',', ':'))
+
+# Subprotocol requested by clients which want responses in binary frames
+BINARY_PROTOCOL = 'codeserver.binary'
+
+
+def encode_response(status: int, sub_status: int = 0, /, body: Union[str, List[str]] = '') -> str:
+    return json_dumps({'status': status, 'sub': sub_status, 'body': body})
+
+
+class Responses:
+    """Constant responses, encoded once instead of on every send"""
+    REGISTER_REQUIRED = encode_response(400, 1, 'register required')
+    BAD_REGISTER = encode_response(400, 2, 'Bad register request')
+    CODE_NOT_SENT = encode_response(400, 3, 'Code not sent yet')
+    PASSWORD_REQUIRED = encode_response(400, 4, 'Password is request')
+    REGISTER_TIMEOUT = encode_response(400, 5, 'Register timeout')
+    PASSWORD_INCORRECT = encode_response(400, 6, 'Password incorrect')
+    MISSING_VERSION = encode_response(400, 7, 'Missing script version, please upgrade script')
+    UPGRADE_REQUIRED = encode_response(400, 8, 'Upgrade script required')
+    BAD_CONTINUE = encode_response(400, 9, 'Bad continue request')
+    FORBIDDEN = encode_response(403, body='Forbidden')
+    SERVER_BUSY = encode_response(503, body='Server busy, please retry later')
+    SERVER_ERROR = encode_response(500, body='Internal server error, please reconnect')
+
+
+class DedupeIndex:
+    """Bounded set of recently seen codes, normalised the same way as database"""
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        self._codes: 'OrderedDict[str, None]' = OrderedDict()
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        return code.lower()
+
+    def __contains__(self, code: str) -> bool:
+        return self.normalize(code) in self._codes
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def add(self, code: str) -> bool:
+        code = self.normalize(code)
+        if code in self._codes:
+            self._codes.move_to_end(code)
+            return False
+        self._codes[code] = None
+        if len(self._codes) > self.capacity:
+            self.evict(len(self._codes) - self.capacity)
+        return True
+
+    def discard(self, code: str) -> None:
+        self._codes.pop(self.normalize(code), None)
+
+    def evict(self, count: int) -> None:
+        for _ in range(min(count, len(self._codes))):
+            self._codes.popitem(last=False)
+
+    def warm(self, codes: Iterable[str]) -> None:
+        for code in codes:
+            self.add(code)
+
+    def load(self, codes: List[str]) -> None:
+        """Replace content at once, faster than `warm` at startup"""
+        self._codes = OrderedDict.fromkeys(map(str.lower, codes[-self.capacity:] if self.capacity else ()))
+
+    def codes(self) -> List[str]:
+        return list(self._codes)
+
+
+class OutboundLimiter:
+    """Frames waiting in outbound queues of all sessions"""
+
+    def __init__(self, max_pending: int = 0):
+        self.max_pending = max_pending
+        self.pending = 0
+
+    @property
+    def full(self) -> bool:
+        return 0 < self.max_pending <= self.pending
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one websocket, drained by a writer task, so a slow client only holds itself.
+    When `max_size` frames are waiting (or the global limit is reached), `policy` decides:
+    `drop-oldest` drops the oldest frame, `coalesce` replaces a waiting frame of the same key (the oldest
+    frame when none), `disconnect` closes the websocket.
+    """
+    POLICIES = ('drop-oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, ws: web.WebSocketResponse, max_size: int = 64, policy: str = 'disconnect',
+                 limiter: Optional[OutboundLimiter] = None, latency: Optional[Histogram] = None,
+                 on_drop: Optional[Callable[[str], None]] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown outbound policy {policy!r}, expect one of {", ".join(self.POLICIES)}')
+        self.ws = ws
+        self.max_size = max_size
+        self.policy = policy
+        self.limiter = limiter if limiter is not None else OutboundLimiter()
+        self.latency = latency
+        self.on_drop = on_drop
+        # (key, frame, enqueued at)
+        self.frames: Deque[Tuple[Hashable, Union[str, bytes], float]] = deque()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        # Seconds from enqueue to written, moving average and max of this session
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+        self._ready = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self._task: Optional[asyncio.Task] = None
+        self._close_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @property
+    def full(self) -> bool:
+        # Global limit only takes from sessions already having a backlog
+        return len(self.frames) >= self.max_size or (bool(self.frames) and self.limiter.full)
+
+    def _pop(self, index: int = 0) -> None:
+        if index:
+            del self.frames[index]
+        else:
+            self.frames.popleft()
+        self.limiter.pending -= 1
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(self.policy)
+
+    def put(self, frame: Union[str, bytes], key: Hashable = None) -> bool:
+        """Queue frame without waiting, return False when it is not going to be sent"""
+        if self.closed:
+            return False
+        if self.full:
+            if self.policy == 'disconnect':
+                self.disconnect()
+                return False
+            index = 0
+            if self.policy == 'coalesce' and key is not None:
+                index = next((index for index, (pending, _, _) in enumerate(self.frames) if pending == key), 0)
+            self._pop(index)
+        self.frames.append((key, frame, time.perf_counter()))
+        self.limiter.pending += 1
+        self._empty.clear()
+        self._ready.set()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            if not self.frames:
+                self._empty.set()
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            _, frame, enqueued = self.frames.popleft()
+            self.limiter.pending -= 1
+            try:
+                if isinstance(frame, bytes):
+                    await self.ws.send_bytes(frame)
+                else:
+                    await self.ws.send_str(frame)
+            except Exception as e:
+                # Connection is gone, handler finds out by its receive loop
+                logger.debug('Stop writer: %r', e)
+                self.closed = True
+                self.limiter.pending -= len(self.frames)
+                self.frames.clear()
+                self._empty.set()
+                return
+            elapsed = time.perf_counter() - enqueued
+            self.latency_avg = elapsed if not self.sent else self.latency_avg * 0.9 + elapsed * 0.1
+            self.latency_max = max(self.latency_max, elapsed)
+            self.sent += 1
+            if self.latency is not None:
+                self.latency.observe(elapsed)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def drain(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._empty.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def disconnect(self) -> None:
+        """Give up on this client, writer is stopped and websocket closed in background"""
+        if self.closed:
+            return
+        self.closed = True
+        logger.warning('Disconnect slow client, %d frame(s) waiting, latency avg %.3fs max %.3fs',
+                       len(self.frames), self.latency_avg, self.latency_max)
+        if self.on_drop is not None:
+            self.on_drop(self.policy)
+        if self._task is not None:
+            self._task.cancel()
+        self._close_task = asyncio.create_task(
+            self.ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow'))
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.debug('Writer stopped by exception', exc_info=True)
+            self._task = None
+        self.limiter.pending -= len(self.frames)
+        self.frames.clear()
+        self._empty.set()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {'pending': len(self.frames), 'sent': self.sent, 'dropped': self.dropped,
+                'latency_avg': self.latency_avg, 'latency_max': self.latency_max}
+
 
 class WsCoroutine:
-    def __init__(self, ws: web.WebSocketResponse, conn: CodeStorage, request_send: asyncio.Event):
+    def __init__(self, ws: web.WebSocketResponse, conn: CodeStorageBackend, request_send: asyncio.Event,
+                 profiler: Optional[Profiler] = None, *, lease_timeout: float = 0, lease_recheck: float = 0,
+                 on_release: Optional[Callable[[], None]] = None, outbound: Optional[OutboundQueue] = None):
         self.ws = ws
+        # Frames are queued for a writer task when set, otherwise sent inline
+        self.outbound = outbound
+        self.binary = ws.ws_protocol == BINARY_PROTOCOL
         self.conn = conn
+        self.profiler = profiler if profiler is not None else Profiler()
         self.request_send = request_send
+        self.code_arrived = asyncio.Event()
         self.stop_event = asyncio.Event()
-        self._identify_id = ''
+        self.identify_id = ''
+        self.version: Tuple[int, ...] = ()
+        # Codes handed out per `continue N`, 1 keeps single code response
+        self.prefetch = 1
         self.last_code = None
-        self.ws_start_time = time.time()
+        self.last_codes: List[str] = []
+        # Set while waiting for new code after storage had nothing left for us, so next new code is ours
+        self.caught_up = False
+        # Exclusive assignment when lease_timeout > 0: code held by this session only, until `continue` or timeout
+        self.lease_timeout = lease_timeout
+        # Look again after this many seconds while waiting, leases expire or are released without notify
+        self.lease_recheck = lease_recheck
+        # Called when a held code becomes available to others
+        self.on_release = on_release
+        self.leased: Optional[str] = None
 
     async def runnable(self) -> None:
         while True:
-            if self.request_send.is_set():
-                self.last_code = await self.conn.request_next_code(self.identify_id)
-                if self.last_code is not None:
-                    await self.ws.send_json(WebServer.build_response_json(200, 0, self.last_code))
-                    self.request_send.clear()
+            await self.request_send.wait()
             if self.stop_event.is_set():
                 return
-            await asyncio.sleep(0.5)
-            if self.ws_start_time is not None and time.time() - self.ws_start_time > 30:
-                await self.ws.send_json(WebServer.build_response_json(400, 5, 'Register timeout'))
-                await self.ws.close()
-                return
+            if self.leased is not None:
+                await self.complete_lease()
+            # Clear before query, so a code arrived during the query will wake us up below
+            self.code_arrived.clear()
+            if self.lease_timeout > 0:
+                with self.profiler.storage('lease_next_code', user=self.identify_id):
+                    self.leased = await self.conn.lease_next_code(self.identify_id, self.lease_timeout)
+                if self.leased is not None:
+                    self.last_code = self.leased
+                    self.last_codes = [self.leased]
+                    self.request_send.clear()
+                    await self.send(encode_response(200, 1, self.last_codes) if self.prefetch > 1 else
+                                    encode_response(200, 0, self.leased), 'code')
+                    continue
+            elif self.prefetch > 1:
+                with self.profiler.storage('request_next_codes', user=self.identify_id):
+                    codes = await self.conn.request_next_codes(self.identify_id, self.prefetch)
+                if codes:
+                    self.last_codes = codes
+                    self.last_code = codes[-1]
+                    self.request_send.clear()
+                    await self.send(encode_response(200, 1, codes), 'code')
+                    continue
+            else:
+                with self.profiler.storage('request_next_code', user=self.identify_id):
+                    self.last_code = await self.conn.request_next_code(self.identify_id)
+                if self.last_code is not None:
+                    self.last_codes = [self.last_code]
+                    self.request_send.clear()
+                    await self.send(encode_response(200, 0, self.last_code), 'code')
+                    continue
+            self.caught_up = True
+            if self.lease_recheck > 0:
+                try:
+                    await asyncio.wait_for(self.code_arrived.wait(), self.lease_recheck)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self.code_arrived.wait()
+            self.caught_up = False
+
+    async def complete_lease(self) -> None:
+        # `continue` after a leased code means it is tried, pass it on to others
+        code, self.leased = self.leased, None
+        with self.profiler.storage('complete_lease', user=self.identify_id, code=code):
+            await self.conn.complete_lease(self.identify_id, code)
+        if self.on_release is not None:
+            self.on_release()
+
+    async def release_lease(self) -> None:
+        if self.leased is None:
+            return
+        code, self.leased = self.leased, None
+        with self.profiler.storage('release_lease', user=self.identify_id, code=code):
+            await self.conn.release_lease(self.identify_id, code)
+        if self.on_release is not None:
+            self.on_release()
+
+    def deliver(self, code: str) -> None:
+        """Take a code handed out by server, frame is sent by server too. Task stays asleep until next `req`"""
+        self.caught_up = False
+        self.last_code = code
+        self.last_codes = [code]
+        self.request_send.clear()
+
+    async def close(self, *, code: int = aiohttp.WSCloseCode.OK, message: bytes = b'', timeout: float = 1) -> None:
+        """Close websocket after frames queued so far are written, or `timeout` seconds"""
+        if self.outbound is not None:
+            await self.outbound.drain(timeout)
+        await self.ws.close(code=code, message=message)
+
+    async def close_by_timeout(self) -> None:
+        await self.send(Responses.REGISTER_TIMEOUT)
+        await self.close()
+
+    async def close_by_error(self) -> None:
+        await self.send(Responses.SERVER_ERROR)
+        await self.close(code=aiohttp.WSCloseCode.INTERNAL_ERROR, message=b'Internal server error')
+
+    async def send(self, payload: str, key: Hashable = None) -> None:
+        # Constant responses coalesce with themselves
+        await self.send_frame(payload.encode() if self.binary else payload, payload if key is None else key)
+
+    async def send_frame(self, frame: Union[str, bytes], key: Hashable = None) -> None:
+        """Send payload already encoded for frame type of this session, `key` tells frames superseding each other"""
+        if self.outbound is not None:
+            self.outbound.put(frame, key)
+            return
+        with self.profiler.stage('send', user=self.identify_id):
+            if isinstance(frame, bytes):
+                await self.ws.send_bytes(frame)
+            else:
+                await self.ws.send_str(frame)
 
-    def req(self) -> None:
+    def notify(self) -> None:
+        self.code_arrived.set()
+
+    def req(self, prefetch: int = 1) -> None:
         logger.debug('Request new code')
+        self.prefetch = prefetch
         self.request_send.set()
+        # Wake up task left waiting by `deliver`
+        self.code_arrived.set()
 
     def req_stop(self):
         logger.debug('Request stop')
         self.stop_event.set()
+        self.request_send.set()
+        self.code_arrived.set()
+
+    async def mark_last_code(self, is_fr: bool, is_other: bool, code: Optional[str] = None) -> None:
+        if code is None:
+            code = self.last_code
+        elif code.lower() not in (sent.lower() for sent in self.last_codes):
+            code = None
+        if code is None:
+            await self.send(Responses.CODE_NOT_SENT)
+            return
+        with self.profiler.storage('mark_code', user=self.identify_id, code=code):
+            await self.conn.mark_code(code, is_fr, is_other)
+
+
+class TimerWheel:
+    """
+    Single task timer for many timeouts which are mostly cancelled before firing.
+    Items are bucketed by tick, so adding and discarding are O(1) and only one sleep is pending.
+    """
+
+    def __init__(self, callback: Callable[[Hashable], None], tick: float = 1.0, span: float = 60):
+        self.callback = callback
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(math.ceil(span / tick) + 1)]
+        self.position = 0
+        self._slot_of: Dict[Hashable, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def add(self, item: Hashable, delay: float) -> None:
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        self.discard(item)
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot].add(item)
+        self._slot_of[item] = slot
+
+    def discard(self, item: Hashable) -> None:
+        slot = self._slot_of.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            self.position = (self.position + 1) % len(self.slots)
+            expired, self.slots[self.position] = self.slots[self.position], set()
+            for item in expired:
+                del self._slot_of[item]
+                try:
+                    self.callback(item)
+                except Exception:
+                    logger.exception('Got exception in timer callback')
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class SessionManager:
+    """Own tasks of websocket sessions: start, register timeout, cancel on disconnect and connection cap"""
+
+    def __init__(self, max_connections: int = 0, register_timeout: float = 30):
+        self.max_connections = max_connections
+        self.register_timeout = register_timeout
+        self.sessions: Set[WsCoroutine] = set()
+        self.tasks: Dict[WsCoroutine, asyncio.Task] = {}
+        self.wheel = TimerWheel(self._on_register_timeout, span=register_timeout)
+        # Tasks closing websockets by server, kept until done
+        self._close_tasks: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
 
     @property
-    def identify_id(self) -> str:
-        return self._identify_id
+    def full(self) -> bool:
+        return 0 < self.max_connections <= len(self.sessions)
 
-    @identify_id.setter
-    def identify_id(self, identify_id: str) -> None:
-        self.ws_start_time = None
-        self._identify_id = identify_id
+    def open(self, wsc: WsCoroutine) -> None:
+        self.sessions.add(wsc)
+        self.tasks[wsc] = task = asyncio.create_task(wsc.runnable())
+        task.add_done_callback(lambda done: self._on_task_done(wsc, done))
+        if wsc.outbound is not None:
+            wsc.outbound.start()
+        self.wheel.add(wsc, self.register_timeout)
 
-    async def mark_last_code(self, is_fr: bool, is_other: bool) -> None:
-        if self.last_code is None:
-            await self.ws.send_json(WebServer.build_response_json(400, 3, 'Code not sent yet'))
-        await self.conn.mark_code(self.last_code, is_fr, is_other)
+    def registered(self, wsc: WsCoroutine) -> None:
+        self.wheel.discard(wsc)
+
+    def _on_register_timeout(self, wsc: WsCoroutine) -> None:
+        if wsc.identify_id or wsc not in self.sessions:
+            return
+        self._close_later(wsc.close_by_timeout())
+
+    def _close_later(self, coro: Coroutine[Any, Any, None]) -> None:
+        task = asyncio.create_task(coro)
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    def _on_task_done(self, wsc: WsCoroutine, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error('Session of %s stopped by exception', wsc.identify_id or 'unregistered user',
+                     exc_info=task.exception())
+        # Client would wait for a code forever otherwise, let it reconnect
+        if wsc in self.sessions:
+            self._close_later(wsc.close_by_error())
+
+    async def close(self, wsc: WsCoroutine) -> None:
+        self.wheel.discard(wsc)
+        self.sessions.discard(wsc)
+        wsc.req_stop()
+        task = self.tasks.pop(wsc, None)
+        if task is None:
+            return
+        # Session may be waiting for storage or for a send which will never complete,
+        # exception of a session which stopped by itself is logged by `_on_task_done`
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                logger.exception('Got exception while process coroutine')
+        if wsc.outbound is not None:
+            await wsc.outbound.close()
+        try:
+            # Hand held code to others at once instead of waiting for lease timeout
+            await wsc.release_lease()
+        except Exception:
+            logger.exception('Got exception while releasing lease')
+
+    def start(self) -> None:
+        self.wheel.start()
+
+    async def stop(self) -> None:
+        self.wheel.stop()
+        await asyncio.gather(*(self.close(wsc) for wsc in list(self.sessions)))
 
 
 class WebServer:
     minimum_version = "4.1.0"
+    # Scripts from this version may use `continue N` and `FR <code>` / `mark_other <code>`
+    prefetch_version = "4.2.0"
 
-    def __init__(self, prefix: str, bind: str, port: int, conn: CodeStorage, auth_password: Optional[str] = None,
-                 ssl_context: Optional[web.SSLContext] = None):
-        self.queue = Queue()
+    def __init__(self, prefix: str, bind: str, port: int, conn: CodeStorageBackend,
+                 auth_password: Optional[str] = None, ssl_context: Optional[web.SSLContext] = None, *,
+                 dedupe_capacity: int = 65536,
+                 enable_metrics: bool = False, metrics_address: Optional[Tuple[str, int]] = None,
+                 reuse_port: bool = False, watch_interval: float = 0, max_prefetch: int = 20,
+                 compress: bool = True, snapshot_file: Optional[str] = None, snapshot_interval: float = 0,
+                 max_connections: int = 0, register_timeout: float = 30,
+                 code_ttl: float = 0, compact_interval: float = 0, compact_step: int = 500,
+                 fan_out: bool = True, profile: bool = False, slow_threshold: float = 0.1,
+                 profile_token: Optional[str] = None, assignment: str = 'shared', lease_timeout: float = 120,
+                 send_queue: int = 64, send_policy: str = 'disconnect', max_outbound: int = 0):
+        self.dedupe = DedupeIndex(dedupe_capacity)
         self.ws_prefix = prefix
         if not self.ws_prefix.startswith('/'):
             self.ws_prefix = f'/{self.ws_prefix}'
@@ -103,91 +594,270 @@ class WebServer:
         self._fetched = False
         self.runner = web.AppRunner(self.website)
         self.website['websockets'] = weakref.WeakSet()
+        self.session_manager = SessionManager(max_connections, register_timeout)
+        self.sessions = self.session_manager.sessions
         self._idled = False
         self.ssl_context = ssl_context
         self._request_stop = False
         self.auth_password = auth_password
+        self.enable_metrics = enable_metrics
+        self.metrics_address = metrics_address
+        self.metrics_runner: Optional[web.AppRunner] = None
+        # Set when several processes serve the same port, codes inserted by others are found by watching storage
+        self.reuse_port = reuse_port
+        self.watch_interval = watch_interval
+        self._watch_task: Optional[asyncio.Task] = None
+        self.max_prefetch = max_prefetch
+        # Offer permessage-deflate to clients, trades CPU for bandwidth
+        self.compress = compress
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_task: Optional[asyncio.Task] = None
+        # Codes older than this many seconds are archived by compaction, 0 to keep them until marked
+        self.code_ttl = code_ttl
+        self.compact_interval = compact_interval
+        self.compact_step = compact_step
+        self._compact_task: Optional[asyncio.Task] = None
+        # Seconds spent from reading config to ready for listen, set by load_from_cfg
+        self.startup_seconds = 0.0
+        # `shared`: every user gets every code in order, `exclusive`: a code is held by one session at a time
+        self.assignment = assignment
+        self.lease_timeout = lease_timeout if assignment == 'exclusive' else 0
+        # Hand a new code straight to caught up sessions, only valid when codes are inserted by this process only
+        self.fan_out = fan_out and not self.lease_timeout
+        # Leases released by other processes or servers are only found by looking again
+        self.lease_recheck = min(self.lease_timeout, 1) if reuse_port or not fan_out else self.lease_timeout
+        # Inserting and fanning out is serialized, so a caught up session never skips a code inserted meanwhile
+        self.insert_lock = asyncio.Lock()
+        self.profile = profile
+        self.slow_threshold = slow_threshold
+        # SHA256 of token required by profile endpoints, endpoints are disabled without it
+        self.profile_token = profile_token
+        self._profiling = False
+        # Frames waiting for each websocket, 0 to send inline
+        self.send_queue = send_queue
+        if send_policy not in OutboundQueue.POLICIES:
+            raise ValueError(f'Unknown send policy {send_policy!r}, expect one of {", ".join(OutboundQueue.POLICIES)}')
+        self.send_policy = send_policy
+        # Frames waiting over all websockets, new connections are refused and backlogs trimmed above it
+        self.outbound_limiter = OutboundLimiter(max_outbound)
+        self.init_metrics()
+
+    def init_metrics(self) -> None:
+        self.metrics = Registry()
+        self.command_counter = self.metrics.register(
+            Counter('codeserver_ws_commands_total', 'WebSocket commands received', ('command',)))
+        self.storage_latency = self.metrics.register(
+            Histogram('codeserver_storage_seconds', 'Latency of CodeStorage calls', ('operation',)))
+        self.lock_wait = self.metrics.register(
+            Histogram('codeserver_sqlite_wait_seconds', 'Time waited for SQLite lock or reader connection',
+                      ('kind',)))
+        self.conn.on_lock_wait = lambda kind, seconds: self.lock_wait.observe(seconds, kind)
+        self.profiler = Profiler(self.storage_latency, self.metrics, enabled=self.profile,
+                                 slow_threshold=self.slow_threshold)
+        self.conn.on_lock_held = self.profiler.on_lock_held
+        self.fan_out_counter = self.metrics.register(
+            Counter('codeserver_fan_out_sessions_total', 'Codes handed to caught up sessions without query'))
+        self.metrics.register(Gauge('codeserver_websockets', 'Connected websockets',
+                                    lambda: len(self.website['websockets'])))
+        self.metrics.register(Gauge('codeserver_unregistered_sessions', 'Sessions waiting for register',
+                                    lambda: len(self.session_manager.wheel)))
+        self.shed_counter = self.metrics.register(
+            Counter('codeserver_shed_connections_total', 'Connections refused by max_connections or max_outbound'))
+        self.archived_counter = self.metrics.register(
+            Counter('codeserver_archived_codes_total', 'Dead codes moved to archive by compaction'))
+        self.send_latency = self.metrics.register(
+            Histogram('codeserver_send_seconds', 'Time from queueing a frame to written to websocket'))
+        self.send_dropped_counter = self.metrics.register(
+            Counter('codeserver_send_dropped_total', 'Frames dropped or clients disconnected by full send queue',
+                    ('policy',)))
+        self.metrics.register(Gauge('codeserver_send_pending', 'Frames waiting in send queues',
+                                    lambda: self.outbound_limiter.pending))
+        self.metrics.register(Gauge('codeserver_leased_codes', 'Codes held by sessions in exclusive assignment',
+                                    lambda: sum(wsc.leased is not None for wsc in self.sessions)))
+        self.metrics.register(Gauge('codeserver_dedupe_size', 'Codes in dedupe index', lambda: len(self.dedupe)))
+        self.metrics.register(Gauge('codeserver_startup_seconds', 'Seconds spent on startup',
+                                    lambda: self.startup_seconds))
+        self.metrics.register(Gauge('codeserver_pending_marks', 'Marks waiting for write-behind flush',
+                                    lambda: len(self.conn.mark_buffer or ())))
+
+    async def handle_metrics(self, _request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    def _check_profile_token(self, request: web.Request) -> None:
+        token = request.headers.get('X-Profile-Token') or request.query.get('token', '')
+        if not hmac.compare_digest(self.get_hash(token), self.profile_token):
+            raise web.HTTPForbidden
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """Sample event loop thread for `seconds`, result is collapsed stacks for flame graph tools"""
+        self._check_profile_token(request)
+        try:
+            seconds = float(request.query.get('seconds', 5))
+        except ValueError:
+            raise web.HTTPBadRequest
+        if not 0 < seconds <= 60:
+            raise web.HTTPBadRequest
+        if self._profiling:
+            raise web.HTTPConflict
+        self._profiling = True
+        try:
+            stacks = await self.profiler.sample(seconds)
+        finally:
+            self._profiling = False
+        return web.Response(text=stacks, content_type='text/plain', charset='utf-8')
+
+    async def handle_loop_stats(self, request: web.Request) -> web.Response:
+        """Event loop lag, max is reset by every request"""
+        self._check_profile_token(request)
+        return web.Response(text=json_dumps(self.profiler.lag_stats()), content_type='application/json')
+
+    async def handle_client_stats(self, request: web.Request) -> web.Response:
+        """Send queue of sessions, slowest first"""
+        self._check_profile_token(request)
+        clients = sorted((dict(user=wsc.identify_id, **wsc.outbound.stats()) for wsc in self.sessions
+                          if wsc.outbound is not None), key=lambda item: item['latency_avg'], reverse=True)
+        return web.Response(text=json_dumps(clients[:100]), content_type='application/json')
 
     @classmethod
-    async def new(cls, prefix: str, bind: str, port: int, conn: CodeStorage, auth_password: Optional[str] = None,
-                  ssl_context: Optional[web.SSLContext] = None):
-        self = cls(prefix, bind, port, conn, auth_password, ssl_context)
+    async def new(cls, prefix: str, bind: str, port: int, conn: CodeStorageBackend,
+                  auth_password: Optional[str] = None, ssl_context: Optional[web.SSLContext] = None, *,
+                  snapshot: Optional[Snapshot] = None, **kwargs):
+        """Create server with dedupe index restored from `snapshot` or warmed from storage, options as `__init__`"""
+        self = cls(prefix, bind, port, conn, auth_password, ssl_context, **kwargs)
+        if snapshot is not None and await snapshot.matches(conn):
+            self.dedupe.load(snapshot.dedupe)
+            logger.debug('Restored dedupe index with %d code(s) from snapshot', len(self.dedupe))
+        else:
+            self.dedupe.load(await conn.fetch_recent_codes(self.dedupe.capacity))
+            logger.debug('Warmed dedupe index with %d code(s)', len(self.dedupe))
         return self
 
     @staticmethod
-    def build_response_json(status: int, sub_status: int = 0, /, body: str = '') -> Dict[str, Union[str, int]]:
+    def build_response_json(status: int, sub_status: int = 0, /, body: Union[str, List[str]] = ''
+                            ) -> Dict[str, Union[str, int, List[str]]]:
         return {'status': status, 'sub': sub_status, 'body': body}
 
+    @staticmethod
+    def parse_version(version: str) -> Tuple[int, ...]:
+        try:
+            return tuple(int(num) for num in version.split('.'))
+        except ValueError:
+            return ()
+
+    @staticmethod
+    def command_name(data: str) -> str:
+        # Bounded set of names, so labels of stage metric do not grow with garbage commands
+        for command in ('register', 'continue', 'FR', 'mark_other', 'close'):
+            if data.startswith(command):
+                return command
+        return 'unknown'
+
     @staticmethod
     def get_hash(text: str) -> str:
         return hashlib.sha256(text.encode()).hexdigest()
 
     async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
         request_next_event = asyncio.Event()
-        ws = web.WebSocketResponse()
-        logger.info('Accept websocket from %s', request.headers.get('X-Real-IP', request.remote))
+        ws = web.WebSocketResponse(protocols=(BINARY_PROTOCOL,), compress=self.compress)
+        remote = request.headers.get('X-Real-IP', request.remote)
 
         await ws.prepare(request)
+        shed = self.session_manager.full or self.outbound_limiter.full
+        outbound = None
+        if self.send_queue > 0 and not shed:
+            outbound = OutboundQueue(ws, self.send_queue, self.send_policy, self.outbound_limiter, self.send_latency,
+                                     self.send_dropped_counter.inc)
+        wsc = WsCoroutine(ws, self.conn, request_next_event, self.profiler, lease_timeout=self.lease_timeout,
+                          lease_recheck=self.lease_recheck,
+                          on_release=self.notify_waiting, outbound=outbound)
+        if shed:
+            # Tell script to come back later instead of letting every session slow down
+            self.shed_counter.inc()
+            logger.warning('Refuse websocket from %s, %d connection(s) and %d waiting frame(s) reached', remote,
+                           len(self.session_manager), self.outbound_limiter.pending)
+            await wsc.send(Responses.SERVER_BUSY)
+            await wsc.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b'Server busy')
+            return ws
+        logger.info('Accept websocket from %s', remote)
         request.app['websockets'].add(ws)
-        wsc = WsCoroutine(ws, self.conn, request_next_event)
-        future = asyncio.run_coroutine_threadsafe(wsc.runnable(), asyncio.get_event_loop())
+        self.session_manager.open(wsc)
         try:
             async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.BINARY and wsc.binary:
+                    msg = msg._replace(type=aiohttp.WSMsgType.TEXT, data=msg.data.decode(errors='ignore'))
                 if msg.type == aiohttp.WSMsgType.TEXT:
-                    if msg.data == 'close':
-                        await ws.close()
-                        break
-                    elif msg.data.startswith('register'):
-                        group = msg.data.split()
-                        length = len(group)
-                        if '_' not in group[0]:
-                            await ws.send_json(self.build_response_json(400, 7, 'Missing script version, '
-                                                                                'please upgrade script'))
-                            continue
-                        else:
-                            _, version = group[0].split('_')
-                            if version < self.minimum_version:
-                                await ws.send_json(
-                                    self.build_response_json(400, 8, 'Upgrade script required'))
-                                await ws.close()
-                                continue
-                        if length != 2 and not self.auth_password:
-                            await ws.send_json(self.build_response_json(400, 2, 'Bad register request'))
-                            continue
-                        elif length != 3 and self.auth_password:
-                            await ws.send_json(self.build_response_json(400, 4, 'Password is request'))
-                            continue
-                        if self.auth_password and group[1] != self.auth_password:
-                            await ws.send_json(self.build_response_json(400, 6, 'Password incorrect'))
-                            continue
-                        wsc.identify_id = group[-1]
-                        wsc.req()
-                    elif msg.data == 'continue':
-                        if not len(wsc.identify_id):
-                            await ws.send_json(self.build_response_json(400, 1, 'register required'))
-                            continue
-                        wsc.req()
-                    elif msg.data == 'FR':
-                        await wsc.mark_last_code(True, False)
-                    elif msg.data == 'mark_other':
-                        await wsc.mark_last_code(False, True)
-                    else:
-                        await ws.send_json(self.build_response_json(403, body='Forbidden'))
+                    with self.profiler.stage(self.command_name(msg.data), user=wsc.identify_id, remote=remote):
+                        if not await self.handle_command(wsc, msg.data):
+                            break
                 elif msg.type == aiohttp.WSMsgType.ERROR:
                     logger.exception('ws connection closed with exception', ws.exception())
                     break
         finally:
-            wsc.req_stop()
             request.app['websockets'].discard(ws)
-            try:
-                future.exception(timeout=1)
-            except concurrent.futures.TimeoutError:
-                pass
-            except:
-                logger.exception('Got exception while process coroutine')
+            await self.session_manager.close(wsc)
         logger.info('websocket connection closed')
         return ws
 
+    async def handle_command(self, wsc: WsCoroutine, data: str) -> bool:
+        """Handle a command from script, return False when websocket is closed"""
+        if data == 'close':
+            await wsc.close()
+            return False
+        elif data.startswith('register'):
+            self.command_counter.inc('register')
+            group = data.split()
+            length = len(group)
+            if '_' not in group[0]:
+                await wsc.send(Responses.MISSING_VERSION)
+                return True
+            else:
+                _, version = group[0].split('_', 1)
+                if self.parse_version(version) < self.parse_version(self.minimum_version):
+                    await wsc.send(Responses.UPGRADE_REQUIRED)
+                    await wsc.close()
+                    return True
+            if length != 2 and not self.auth_password:
+                await wsc.send(Responses.BAD_REGISTER)
+                return True
+            elif length != 3 and self.auth_password:
+                await wsc.send(Responses.PASSWORD_REQUIRED)
+                return True
+            if self.auth_password and group[1] != self.auth_password:
+                await wsc.send(Responses.PASSWORD_INCORRECT)
+                return True
+            wsc.identify_id = group[-1]
+            wsc.version = self.parse_version(version)
+            self.session_manager.registered(wsc)
+            wsc.req()
+        elif data == 'continue':
+            self.command_counter.inc('continue')
+            if not len(wsc.identify_id):
+                await wsc.send(Responses.REGISTER_REQUIRED)
+                return True
+            wsc.req()
+        elif data == 'FR':
+            self.command_counter.inc('FR')
+            await wsc.mark_last_code(True, False)
+        elif data == 'mark_other':
+            self.command_counter.inc('mark_other')
+            await wsc.mark_last_code(False, True)
+        elif wsc.version >= self.parse_version(self.prefetch_version) and \
+                data.startswith(('continue ', 'FR ', 'mark_other ')):
+            command, argument = data.split(maxsplit=1)
+            self.command_counter.inc(command)
+            if command != 'continue':
+                await wsc.mark_last_code(command == 'FR', command == 'mark_other', argument)
+                return True
+            if not argument.isdigit() or int(argument) < 1:
+                await wsc.send(Responses.BAD_CONTINUE)
+                return True
+            wsc.req(min(int(argument), self.max_prefetch))
+        else:
+            await wsc.send(Responses.FORBIDDEN)
+        return True
+
     @staticmethod
     async def handle_web_shutdown(app: web.Application) -> None:
         for ws in set(app['websockets']):
@@ -199,32 +869,198 @@ class WebServer:
         self.website.router.add_get('/', inner_handle)
         self.website.router.add_get(self.ws_prefix, self.handle_websocket)
         self.website.on_shutdown.append(self.handle_web_shutdown)
+        if self.enable_metrics and self.metrics_address is None:
+            self.website.router.add_get('/metrics', self.handle_metrics)
+        if self.profile and self.profile_token:
+            self.website.router.add_get('/debug/profile', self.handle_profile)
+            self.website.router.add_get('/debug/loop', self.handle_loop_stats)
+            self.website.router.add_get('/debug/clients', self.handle_client_stats)
         await self.runner.setup()
-        self.site = web.TCPSite(self.runner, self.bind, self.port, ssl_context=self.ssl_context)
+        self.site = web.TCPSite(self.runner, self.bind, self.port, ssl_context=self.ssl_context,
+                                reuse_port=self.reuse_port or None)
         await self.site.start()
-        logger.info('Listen websocket on ws%s://%s:%d%s',
+        logger.info('Listen websocket on ws%s://%s:%d%s (pid %d)',
                     's' if self.ssl_context is not None else '',
-                    self.bind, self.port, self.ws_prefix)
+                    self.bind, self.port, self.ws_prefix, os.getpid())
+        if self.watch_interval > 0:
+            self._watch_task = asyncio.create_task(self._watch_storage())
+        if self.snapshot_file and self.snapshot_interval > 0:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        if self.compact_interval > 0:
+            self._compact_task = asyncio.create_task(self._compact_loop())
+        self.session_manager.start()
+        self.profiler.start()
+        if self.enable_metrics and self.metrics_address is not None:
+            metrics_app = web.Application()
+            metrics_app.router.add_get('/metrics', self.handle_metrics)
+            self.metrics_runner = web.AppRunner(metrics_app)
+            await self.metrics_runner.setup()
+            await web.TCPSite(self.metrics_runner, *self.metrics_address).start()
+            logger.info('Listen metrics on http://%s:%d/metrics', *self.metrics_address)
 
     async def stop(self) -> None:
         self._request_stop = True
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+        self.profiler.stop()
         await self.site.stop()
         await self.runner.cleanup()
+        await self.session_manager.stop()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        if self.snapshot_file:
+            await self.write_snapshot()
+        await self.conn.close()
+
+    async def write_snapshot(self) -> None:
+        start = time.perf_counter()
+        snapshot = await Snapshot.take(self.conn, self.dedupe.codes())
+        await asyncio.get_running_loop().run_in_executor(None, snapshot.dump, self.snapshot_file)
+        logger.debug('Wrote snapshot to %s in %.3fs', self.snapshot_file, time.perf_counter() - start)
+
+    async def compact(self) -> int:
+        """Archive dead codes step by step, so the writer is never held for long"""
+        archived = 0
+        while codes := await self.conn.compact_step(self.code_ttl, self.compact_step):
+            archived += len(codes)
+            for code in codes:
+                self.dedupe.discard(code)
+            # Let sessions use the writer between steps
+            await asyncio.sleep(0)
+        if archived:
+            self.archived_counter.inc(amount=archived)
+            logger.info('Archived %d dead code(s)', archived)
+        return archived
+
+    async def _compact_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception('Got exception while compacting storage')
+
+    async def _snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.write_snapshot()
+            except Exception:
+                logger.exception('Got exception while writing snapshot')
 
     async def put_passcode(self, code: str, *, from_storage: bool = False) -> str:
-        if code in self.queue.queue:
-            return code
         if code.startswith('/'):
             return code
-        self.queue.put_nowait(code)
+        if code in self.dedupe:
+            return code
+        targets = []
         if not from_storage:
-            if not await self.conn.insert_code(code):
-                return code
+            async with self.insert_lock:
+                with self.profiler.storage('insert_code', code=code):
+                    inserted = await self.conn.insert_code(code)
+                self.dedupe.add(code)
+                if not inserted:
+                    return code
+                targets = await self.assign_caught_up([code.lower()])
+        else:
+            self.dedupe.add(code)
         logger.debug("Insert code => %s to database", code)
+        self.notify_waiting()
+        await self.broadcast(code.lower(), targets)
         return code
 
+    async def put_passcodes(self, codes: Iterable[str]) -> InsertResult:
+        batch = []
+        duplicated = []
+        for code in codes:
+            if code.startswith('/'):
+                continue
+            if code in self.dedupe:
+                duplicated.append(code)
+                continue
+            batch.append(code)
+        async with self.insert_lock:
+            with self.profiler.storage('insert_codes', count=len(batch)):
+                result = await self.conn.insert_codes(batch)
+            self.dedupe.warm(batch)
+            targets = await self.assign_caught_up(result.inserted) if result.inserted else []
+        result.duplicated.extend(duplicated)
+        if result.inserted:
+            logger.debug("Insert %d code(s) to database, %d duplicated", len(result.inserted), len(result.duplicated))
+            self.notify_waiting()
+            await self.broadcast(result.inserted[0], targets)
+        return result
+
+    async def assign_caught_up(self, codes: List[str]) -> List[WsCoroutine]:
+        """
+        Hand first of newly inserted codes to sessions which had nothing left, cursors move in one write.
+        Sessions asking several codes are left to query when more than one code arrived.
+        """
+        if not self.fan_out:
+            return []
+        targets = [wsc for wsc in self.sessions if wsc.caught_up and (wsc.prefetch == 1 or len(codes) == 1)]
+        if not targets:
+            return []
+        for wsc in targets:
+            wsc.deliver(codes[0])
+        try:
+            with self.profiler.storage('assign_code', sessions=len(targets)):
+                await self.conn.assign_code(codes[0], [wsc.identify_id for wsc in targets])
+        except Exception:
+            logger.exception('Got exception while assigning code to %d session(s)', len(targets))
+            # Let them query as usual
+            for wsc in targets:
+                wsc.req(wsc.prefetch)
+            return []
+        return targets
+
+    async def broadcast(self, code: str, targets: List[WsCoroutine]) -> None:
+        """Send code to sessions assigned by `assign_caught_up`, frame is encoded once per response and frame type"""
+        if not targets:
+            return
+        self.fan_out_counter.inc(amount=len(targets))
+        frames: Dict[Tuple[bool, bool], Union[str, bytes]] = {}
+        sends = []
+        with self.profiler.stage('encode', sessions=len(targets)):
+            for wsc in targets:
+                key = (wsc.prefetch > 1, wsc.binary)
+                frame = frames.get(key)
+                if frame is None:
+                    frame = encode_response(200, 1, [code]) if key[0] else encode_response(200, 0, code)
+                    frame = frames[key] = frame.encode() if wsc.binary else frame
+                sends.append(wsc.send_frame(frame, 'code'))
+        with self.profiler.stage('broadcast', sessions=len(targets)):
+            await asyncio.gather(*sends, return_exceptions=True)
+
+    async def _watch_storage(self) -> None:
+        last_id = await self.conn.latest_code_id()
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                current_id = await self.conn.latest_code_id()
+            except Exception:
+                logger.exception('Got exception while watching storage')
+                continue
+            if current_id != last_id:
+                last_id = current_id
+                self.notify_waiting()
+
+    def notify_waiting(self) -> None:
+        for wsc in self.sessions:
+            if wsc.request_send.is_set():
+                wsc.notify()
+
     async def mark_passcode(self, code: str, is_fr: bool, is_other: bool = False) -> None:
-        await self.conn.mark_code(code, is_fr, is_other)
+        with self.profiler.storage('mark_code', code=code):
+            await self.conn.mark_code(code, is_fr, is_other)
+
+    async def mark_passcodes(self, marks: List[Tuple[str, bool, bool]]) -> None:
+        with self.profiler.storage('mark_codes', count=len(marks)):
+            await self.conn.mark_codes(marks)
 
     async def idle(self):
         self._idled = True
@@ -244,7 +1080,8 @@ class WebServer:
             self._idled = False
 
     @classmethod
-    async def load_from_cfg(cls, config: ConfigParser, debug: bool = False) -> 'WebServer':
+    async def load_from_cfg(cls, config: ConfigParser, debug: bool = False, *, worker: bool = False,
+                            profile: bool = False) -> 'WebServer':
         ssl_context = None
         auth_password = None
         if config.getboolean('ssl', 'enabled', fallback=False):
@@ -256,11 +1093,94 @@ class WebServer:
             )
         if config.getboolean('auth', 'enabled', fallback=False):
             auth_password = config.get('auth', 'passwd_sha')
-        return await cls.new(
+        metrics_address = None
+        if config.get('metrics', 'bind', fallback=''):
+            metrics_address = (config.get('metrics', 'bind'), config.getint('metrics', 'port', fallback=29986))
+        multi_process = config.getint('web', 'workers', fallback=1) > 1
+        assignment = config.get('storage', 'assignment', fallback='shared')
+        if assignment not in ('shared', 'exclusive'):
+            raise ValueError(f'Unknown assignment {assignment!r}, expect shared or exclusive')
+        start = time.perf_counter()
+        snapshot = snapshot_file = None
+        # Workers share database with main process, which owns the snapshot
+        if config.getboolean('snapshot', 'enabled', fallback=False) and not worker:
+            snapshot_file = config.get('snapshot', 'file', fallback='codeserver.snapshot')
+            snapshot = Snapshot.load(snapshot_file, config.getfloat('snapshot', 'max_age', fallback=86400))
+        state = (snapshot.fingerprint, snapshot.storage) if snapshot is not None and snapshot.storage else None
+        self = await cls.new(
             config.get('web', 'ws_prefix'),
             config.get('web', 'bind'),
             config.getint('web', 'port', fallback=29985),
-            await CodeStorage.new('codeserver.db', renew=debug),
+            await open_storage(config, renew=debug and not worker, multi_process=multi_process, state=state),
             auth_password,
-            ssl_context
+            ssl_context,
+            dedupe_capacity=config.getint('web', 'dedupe_capacity', fallback=65536),
+            enable_metrics=config.getboolean('metrics', 'enabled', fallback=False) and not worker,
+            metrics_address=metrics_address,
+            reuse_port=multi_process,
+            watch_interval=config.getfloat('web', 'watch_interval', fallback=0.1) if multi_process else 0,
+            max_prefetch=config.getint('web', 'max_prefetch', fallback=20),
+            compress=config.getboolean('web', 'compress', fallback=True),
+            snapshot_file=snapshot_file,
+            snapshot_interval=config.getfloat('snapshot', 'interval', fallback=300),
+            snapshot=snapshot,
+            max_connections=config.getint('web', 'max_connections', fallback=0),
+            register_timeout=config.getfloat('web', 'register_timeout', fallback=30),
+            code_ttl=config.getfloat('storage', 'code_ttl', fallback=0),
+            # Workers share database with main process, which does the compaction
+            compact_interval=config.getfloat('storage', 'compact_interval', fallback=0) if not worker else 0,
+            compact_step=config.getint('storage', 'compact_step', fallback=500),
+            # Codes inserted by other processes are only seen by querying, so they must not be skipped over
+            fan_out=config.getboolean('web', 'fan_out', fallback=True) and not multi_process and
+            config.get('storage', 'engine', fallback='sqlite') != 'redis',
+            profile=profile,
+            slow_threshold=config.getfloat('profile', 'slow_threshold', fallback=0.1),
+            profile_token=config.get('profile', 'token_sha', fallback='') or None,
+            assignment=assignment,
+            lease_timeout=config.getfloat('storage', 'lease_timeout', fallback=120),
+            send_queue=config.getint('web', 'send_queue', fallback=64),
+            send_policy=config.get('web', 'send_policy', fallback='disconnect'),
+            max_outbound=config.getint('web', 'max_outbound', fallback=0)
         )
+        self.startup_seconds = time.perf_counter() - start
+        logger.info('Server initialized in %.3fs', self.startup_seconds)
+        return self
+
+
+async def _worker_main(config_file: str, debug: bool, profile: bool) -> None:
+    config = ConfigParser()
+    config.read(config_file)
+    website = await WebServer.load_from_cfg(config, debug, worker=True, profile=profile)
+    await website.start()
+    await website.idle()
+    await website.stop()
+
+
+def run_worker(config_file: str, debug: bool = False, profile: bool = False) -> None:
+    """Entry of additional worker process, serve websocket only, share listen port and database with main process"""
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO,
+                        format='%(asctime)s - %(process)d - %(levelname)s - %(funcName)s - %(lineno)d - %(message)s')
+    logging.getLogger('aiosqlite').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp').setLevel(logging.WARNING)
+    asyncio.run(_worker_main(config_file, debug, profile))
+
+
+def spawn_workers(config_file: str, count: int, debug: bool = False,
+                  profile: bool = False) -> List[multiprocessing.Process]:
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for _ in range(count):
+        process = context.Process(target=run_worker, args=(config_file, debug, profile), daemon=True)
+        process.start()
+        workers.append(process)
+    logger.info('Started %d worker process(es)', len(workers))
+    return workers
+
+
+def stop_workers(workers: List[multiprocessing.Process], timeout: float = 3) -> None:
+    for process in workers:
+        # Workers share terminal with main process, so they may already be stopping by same signal
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join()
@@ -16,29 +16,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 import asyncio
-import re
 import logging
+from typing import Awaitable, Callable
 
 from pyrogram import Client, filters
 from pyrogram.handlers import MessageHandler
 from pyrogram.types import Message
 
+from libingest import IngestPipeline, IngestResult
 from localserver import WebServer
 
-PASSCODE_EXP = re.compile(r'^\w{5,20}$')
-
 logger = logging.getLogger('receiver.bot')
 logger.setLevel(logging.DEBUG)
 
 
 class Receiver:
-    def __init__(self, api_id: int, api_hash: str, bot_token: str, listen_user: str, website: WebServer):
+    def __init__(self, api_id: int, api_hash: str, bot_token: str, listen_user: str, website: WebServer, *,
+                 reply_summary: bool = False, max_pending: int = 64, batch_size: int = 500):
         self.api_id = api_id
         self.api_hash = api_hash
         self.bot_token = bot_token
         self.bot = Client('receiver', api_id=api_id, api_hash=api_hash, bot_token=bot_token)
         self.listen_user = listen_user
         self.website = website
+        self.reply_summary = reply_summary
+        self.pipeline = IngestPipeline(website.put_passcodes, max_pending=max_pending, batch_size=batch_size)
         self.init_handle()
 
     def init_handle(self) -> None:
@@ -46,22 +48,24 @@ class Receiver:
             MessageHandler(self.handle_incoming_passcode, filters.chat(self.listen_user) & filters.text))
 
     async def handle_incoming_passcode(self, _client: Client, msg: Message) -> None:
-        # logger.info('Put passcode => %s', msg.text)
-        if '\n' in msg.text:
-            for code in msg.text.splitlines(False):
-                code = code.strip()
-                if not len(code) or code.startswith('#'):
-                    continue
-                r = PASSCODE_EXP.match(code)
-                if r is None:
-                    logger.warning('Skipped code => %s', code)
-                await self.website.put_passcode(code)
-        elif not msg.text.startswith('#'):
-            await self.website.put_passcode(msg.text)
+        # Only waits when ingest queue is full
+        await self.pipeline.submit(msg.text, self._reply_summary(msg) if self.reply_summary else None)
+
+    @staticmethod
+    def _reply_summary(msg: Message) -> Callable[[IngestResult], Awaitable[None]]:
+        async def reply(result: IngestResult) -> None:
+            try:
+                await msg.reply_text(f'Accepted: {result.accepted}\nDuplicated: {result.duplicated}\n'
+                                     f'Invalid: {result.invalid}', quote=True)
+            except Exception:
+                logger.exception('Got exception while reply summary')
+        return reply
 
     @classmethod
-    async def new(cls, api_id: int, api_hash: str, bot_token: str, listen_user: str, website: WebServer) -> 'Receiver':
-        return cls(api_id, api_hash, bot_token, listen_user, website)
+    async def new(cls, api_id: int, api_hash: str, bot_token: str, listen_user: str, website: WebServer, *,
+                  reply_summary: bool = False, max_pending: int = 64, batch_size: int = 500) -> 'Receiver':
+        return cls(api_id, api_hash, bot_token, listen_user, website, reply_summary=reply_summary,
+                   max_pending=max_pending, batch_size=batch_size)
 
     async def start_bot(self) -> None:
         await self.bot.start()
@@ -70,10 +74,14 @@ class Receiver:
         await self.bot.stop()
 
     async def start(self) -> None:
+        self.pipeline.start()
         await asyncio.gather(self.start_bot(), self.website.start())
 
     async def stop(self) -> None:
-        await asyncio.gather(self.stop_bot(), self.website.stop())
+        await self.stop_bot()
+        # Insert everything received before closing storage
+        await self.pipeline.close()
+        await self.website.stop()
 
     async def idle(self) -> None:
         await self.website.idle()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# test_concurrency.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+import random
+import time
+from configparser import ConfigParser
+from typing import Dict, List, Optional
+
+import aiohttp
+import pytest
+
+from libsqlite import CodeStorage, MemoryCodeStorage
+from localserver import WebServer, spawn_workers, stop_workers
+from test_localserver import find_free_port
+
+
+async def open_storage(engine: str, tmp_path):
+    if engine == 'redis':
+        fakeredis = pytest.importorskip('fakeredis')
+        from libredis import RedisCodeStorage
+        return RedisCodeStorage(fakeredis.FakeAsyncRedis(decode_responses=True), 'test')
+    storage_cls = {'sqlite': CodeStorage, 'memory': MemoryCodeStorage}[engine]
+    return await storage_cls.new(os.path.join(tmp_path, 'test.db'))
+
+
+async def wait_listen(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with aiohttp.ClientSession() as session, session.get(f'http://127.0.0.1:{port}/'):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(.2)
+    raise TimeoutError(f'Nothing listen on port {port}')
+
+
+async def shared_session(url: str, user: str, expect: int) -> List[str]:
+    codes = []
+    async with aiohttp.ClientSession() as session, session.ws_connect(url) as ws:
+        await ws.send_str(f'register_{WebServer.minimum_version} {user}')
+        while len(codes) < expect:
+            data = await ws.receive_json(timeout=30)
+            assert data['status'] == 200, f'{user} got unexpected response {data}'
+            codes.append(data['body'])
+            await ws.send_str('continue')
+        await ws.send_str('close')
+    return codes
+
+
+async def exclusive_session(url: str, user: str, expect: int, holders: Dict[str, str], overlaps: List[str],
+                            drop_every: int = 0) -> List[str]:
+    """Try every code once, sometimes disconnect while holding a code, which must be handed out again"""
+    tried = []
+    received = 0
+    async with aiohttp.ClientSession() as session:
+        while len(tried) < expect:
+            async with session.ws_connect(url) as ws:
+                await ws.send_str(f'register_{WebServer.minimum_version} {user}')
+                while len(tried) < expect:
+                    data = await ws.receive_json(timeout=30)
+                    assert data['status'] == 200, f'{user} got unexpected response {data}'
+                    code = data['body']
+                    received += 1
+                    if code in holders:
+                        overlaps.append(f'{code} held by {holders[code]} and {user}')
+                    holders[code] = user
+                    await asyncio.sleep(random.random() / 500)
+                    # Leave before server is told, so server must not hand it out before seeing us go
+                    del holders[code]
+                    if drop_every and received % drop_every == 0:
+                        break
+                    tried.append(code)
+                    await ws.send_str('continue')
+    return tried
+
+
+async def stall_session(url: str, stop: asyncio.Event) -> Optional[str]:
+    """Hold first code and never answer, its lease must expire"""
+    async with aiohttp.ClientSession() as session, session.ws_connect(url) as ws:
+        await ws.send_str(f'register_{WebServer.minimum_version} staller')
+        data = await ws.receive_json(timeout=30)
+        await stop.wait()
+        return data['body']
+
+
+async def put_in_bursts(server: WebServer, codes: List[str]) -> None:
+    # Feed codes in small bursts while clients are consuming
+    for offset in range(0, len(codes), 10):
+        await server.put_passcodes(codes[offset:offset + 10])
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize('engine', ['sqlite', 'memory', 'redis'])
+async def test_shared_stress(tmp_path, engine):
+    server = WebServer('ws', '127.0.0.1', find_free_port(), await open_storage(engine, tmp_path))
+    await server.start()
+    try:
+        expected = [f'stresscode{num:06d}' for num in range(50)]
+        sessions = [asyncio.create_task(shared_session(f'http://127.0.0.1:{server.port}/ws', f'user{user}',
+                                                       len(expected)))
+                    for user in range(30)]
+        await put_in_bursts(server, expected)
+        for result in await asyncio.gather(*sessions):
+            assert result == expected
+    finally:
+        await server.stop()
+
+
+async def test_shared_stress_workers(tmp_path):
+    port = find_free_port()
+    config = ConfigParser()
+    config.read_dict({
+        'web': {'bind': '127.0.0.1', 'port': str(port), 'ws_prefix': 'ws', 'workers': '3'},
+        'storage': {'database': os.path.join(tmp_path, 'test.db')},
+    })
+    config_file = os.path.join(tmp_path, 'config.ini')
+    with open(config_file, 'w') as fout:
+        config.write(fout)
+    server = await WebServer.load_from_cfg(config)
+    workers = spawn_workers(config_file, 2)
+    try:
+        await wait_listen(port)
+        await server.start()
+        expected = [f'stresscode{num:06d}' for num in range(30)]
+        sessions = [asyncio.create_task(shared_session(f'http://127.0.0.1:{port}/ws', f'user{user}', len(expected)))
+                    for user in range(60)]
+        await put_in_bursts(server, expected)
+        for result in await asyncio.gather(*sessions):
+            assert result == expected
+    finally:
+        await server.stop()
+        stop_workers(workers, 0)
+
+
+@pytest.mark.parametrize('engine', ['sqlite', 'memory', 'redis'])
+async def test_exclusive_stress(tmp_path, engine):
+    server = WebServer('ws', '127.0.0.1', find_free_port(), await open_storage(engine, tmp_path),
+                       assignment='exclusive', lease_timeout=1)
+    await server.start()
+    try:
+        url = f'http://127.0.0.1:{server.port}/ws'
+        holders: Dict[str, str] = {}
+        overlaps: List[str] = []
+        expected = [f'leasecode{num:06d}' for num in range(40)]
+        await server.put_passcodes(expected[:1])
+        stop = asyncio.Event()
+        staller = asyncio.create_task(stall_session(url, stop))
+        # Staller takes first code before anyone else
+        while not any(wsc.leased for wsc in server.sessions):
+            await asyncio.sleep(.01)
+        sessions = [asyncio.create_task(exclusive_session(url, f'user{user}', len(expected), holders, overlaps,
+                                                          drop_every=7 if user % 4 == 0 else 0))
+                    for user in range(20)]
+        await put_in_bursts(server, expected[1:])
+        results = await asyncio.gather(*sessions)
+        stop.set()
+        assert await staller == expected[0]
+        assert not overlaps
+        for result in results:
+            assert sorted(result) == expected
+    finally:
+        await server.stop()
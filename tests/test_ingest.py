@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# test_ingest.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+
+import pytest
+
+from libingest import IngestPipeline, IngestResult, PasscodeBridge
+from libsqlite import CodeStorage, InsertResult
+
+
+class FlakyServer:
+    def __init__(self, fail_codes: int = 0, fail_marks: int = 0):
+        self.fail_codes = fail_codes
+        self.fail_marks = fail_marks
+        self.codes = []
+        self.marks = []
+
+    async def put_passcodes(self, codes):
+        if self.fail_codes:
+            self.fail_codes -= 1
+            raise RuntimeError('database is locked')
+        codes = list(codes)
+        self.codes.extend(codes)
+        return InsertResult(codes, [])
+
+    async def mark_passcodes(self, marks):
+        if self.fail_marks:
+            self.fail_marks -= 1
+            raise RuntimeError('database is locked')
+        self.marks.extend(marks)
+
+
+async def test_bridge_keeps_batch_of_failed_insert():
+    server = FlakyServer(fail_codes=1)
+    bridge = PasscodeBridge(server.put_passcodes, server.mark_passcodes, batch_size=2)
+    for code in ('code1', 'code2', 'code3'):
+        await bridge.put_passcode(code)
+    await bridge.mark_passcode('code1', True)
+    with pytest.raises(RuntimeError):
+        await bridge.flush()
+    assert list(bridge.codes) == ['code1', 'code2', 'code3']
+    # Still deduplicated against buffered codes
+    await bridge.put_passcode('code2')
+    await bridge.put_passcode('code4')
+    await bridge.mark_passcode('code1', False, True)
+    await bridge.flush()
+    assert server.codes == ['code1', 'code2', 'code3', 'code4']
+    assert server.marks == [('code1', False, True)]
+    assert not len(bridge)
+
+
+async def test_bridge_keeps_marks_of_failed_write():
+    server = FlakyServer(fail_marks=1)
+    bridge = PasscodeBridge(server.put_passcodes, server.mark_passcodes)
+    await bridge.put_passcode('code1')
+    await bridge.mark_passcode('code1', True)
+    with pytest.raises(RuntimeError):
+        await bridge.flush()
+    assert not bridge.codes
+    assert bridge.marks == {'code1': (True, False)}
+    await bridge.close()
+    assert server.codes == ['code1']
+    assert server.marks == [('code1', True, False)]
+
+
+class RecordingStorage:
+    def __init__(self, conn: CodeStorage):
+        self.conn = conn
+        self.batches = []
+
+    async def put_passcodes(self, codes):
+        codes = list(codes)
+        self.batches.append(codes)
+        return await self.conn.insert_codes(codes)
+
+
+async def test_pipeline_merges_waiting_messages(tmp_path):
+    conn = await CodeStorage.new(os.path.join(tmp_path, 'test.db'))
+    storage = RecordingStorage(conn)
+    results = {}
+
+    def reply(name):
+        async def on_done(result):
+            results[name] = result
+        return on_done
+
+    pipeline = IngestPipeline(storage.put_passcodes, batch_size=4)
+    try:
+        await pipeline.submit('code01\ncode02', reply('first'))
+        await pipeline.submit('CODE02\n#comment\n/start\nbad!\ncode03', reply('second'))
+        await pipeline.submit('code01\ncode04', reply('third'))
+        pipeline.start()
+        await pipeline.close()
+        # Second message brings the batch to batch_size lines, third goes to the next insert
+        assert storage.batches == [['code01', 'code02', 'CODE02', 'code03'], ['code01', 'code04']]
+        assert results == {'first': IngestResult(2, 0, 0), 'second': IngestResult(1, 1, 1),
+                           'third': IngestResult(1, 1, 0)}
+    finally:
+        await conn.close()
+
+
+async def test_pipeline_blocks_when_full():
+    server = FlakyServer()
+    pipeline = IngestPipeline(server.put_passcodes, max_pending=2)
+    await pipeline.submit('code01')
+    await pipeline.submit('code02')
+    blocked = asyncio.create_task(pipeline.submit('code03'))
+    await asyncio.sleep(.05)
+    assert not blocked.done()
+    pipeline.start()
+    await asyncio.wait_for(blocked, 1)
+    await pipeline.close()
+    assert server.codes == ['code01', 'code02', 'code03']
+
+
+async def test_pipeline_survives_storage_error():
+    server = FlakyServer(fail_codes=1)
+    results = []
+
+    async def on_done(result):
+        results.append(result)
+
+    pipeline = IngestPipeline(server.put_passcodes)
+    pipeline.start()
+    await pipeline.submit('code01', on_done)
+    await pipeline.queue.join()
+    await pipeline.submit('code02', on_done)
+    await pipeline.close()
+    assert server.codes == ['code02']
+    assert results == [IngestResult(1, 0, 0)]
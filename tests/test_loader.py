@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# test_loader.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import os
+import sqlite3
+
+from libloader import PasscodeLoader
+from libsqlite import InsertResult
+
+
+class Collector:
+    def __init__(self):
+        self.codes = []
+
+    async def put_passcodes(self, codes):
+        self.codes.extend(codes)
+        return InsertResult(list(codes), [])
+
+
+class FlakyCollector(Collector):
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def put_passcodes(self, codes):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return await super().put_passcodes(codes)
+
+
+async def test_load_last_line_without_newline(tmp_path):
+    path = os.path.join(tmp_path, 'passcode.txt')
+    checkpoint = os.path.join(tmp_path, 'passcode.checkpoint')
+    with open(path, 'w') as fout:
+        fout.write('abcde1\nabcde2\nabcde3')
+    collector = Collector()
+    loader = PasscodeLoader(path, collector.put_passcodes, checkpoint_file=checkpoint, chunk_size=4)
+    assert await loader.load() == 3
+    assert collector.codes == ['abcde1', 'abcde2', 'abcde3']
+    with open(checkpoint) as fin:
+        assert json.load(fin)[path]['offset'] == os.path.getsize(path)
+    assert await loader.load() == 0
+
+
+async def test_watch_waits_for_last_line(tmp_path):
+    path = os.path.join(tmp_path, 'passcode.txt')
+    with open(path, 'w') as fout:
+        fout.write('abcde1\nabc')
+    collector = Collector()
+    loader = PasscodeLoader(path, collector.put_passcodes)
+    loader.watching = True
+    await loader.load()
+    assert collector.codes == ['abcde1']
+    # Line is completed before next round
+    with open(path, 'a') as fout:
+        fout.write('de2')
+    await loader.load()
+    assert collector.codes == ['abcde1']
+    # File did not grow for a round, line is taken as it is
+    await loader.load()
+    assert collector.codes == ['abcde1', 'abcde2']
+    with open(path, 'a') as fout:
+        fout.write('\nabcde3\n')
+    await loader.load()
+    assert collector.codes == ['abcde1', 'abcde2', 'abcde3']
+
+
+async def test_watch_survives_storage_error(tmp_path):
+    path = os.path.join(tmp_path, 'passcode.txt')
+    with open(path, 'w') as fout:
+        fout.write('abcde1\nabcde2\nabcde3\n')
+    collector = FlakyCollector(2)
+    loader = PasscodeLoader(path, collector.put_passcodes, batch_size=2)
+    loader.start(.01)
+    try:
+        for _ in range(100):
+            if len(collector.codes) == 3:
+                break
+            await asyncio.sleep(.01)
+        assert collector.codes == ['abcde1', 'abcde2', 'abcde3']
+        assert loader.checkpoint[path]['offset'] == os.path.getsize(path)
+        with open(path, 'a') as fout:
+            fout.write('abcde4\n')
+        for _ in range(100):
+            if len(collector.codes) == 4:
+                break
+            await asyncio.sleep(.01)
+        assert collector.codes[-1] == 'abcde4'
+    finally:
+        await loader.stop()
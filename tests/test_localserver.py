@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# test_localserver.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import json
+import os
+import socket
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+import pytest
+
+from libsqlite import CodeStorage
+from localserver import OutboundLimiter, OutboundQueue, Responses, WebServer
+
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def running_server(tmp_path, **kwargs) -> AsyncIterator[WebServer]:
+    server = WebServer('ws', '127.0.0.1', find_free_port(),
+                       await CodeStorage.new(os.path.join(tmp_path, 'test.db')), **kwargs)
+    await server.start()
+    try:
+        yield server
+    finally:
+        await server.stop()
+
+
+@pytest.mark.parametrize('send_queue', [0, 64])
+async def test_upgrade_required_sent_before_close(tmp_path, send_queue):
+    async with running_server(tmp_path, send_queue=send_queue) as server, aiohttp.ClientSession() as session:
+        async with session.ws_connect(f'http://127.0.0.1:{server.port}/ws') as ws:
+            await ws.send_str('register_4.0.0 user')
+            msg = await ws.receive(timeout=5)
+            assert msg.type == aiohttp.WSMsgType.TEXT
+            assert msg.data == Responses.UPGRADE_REQUIRED
+            assert (await ws.receive(timeout=5)).type == aiohttp.WSMsgType.CLOSE
+
+
+async def test_register_timeout_sent_before_close(tmp_path):
+    async with running_server(tmp_path, register_timeout=1) as server, aiohttp.ClientSession() as session:
+        async with session.ws_connect(f'http://127.0.0.1:{server.port}/ws') as ws:
+            assert json.loads((await ws.receive(timeout=5)).data)['sub'] == 5
+            assert (await ws.receive(timeout=5)).type == aiohttp.WSMsgType.CLOSE
+
+
+async def test_storage_error_closes_session(tmp_path, monkeypatch):
+    async def broken(*_args):
+        raise RuntimeError('storage is gone')
+
+    async with running_server(tmp_path) as server, aiohttp.ClientSession() as session:
+        monkeypatch.setattr(server.conn, 'request_next_code', broken)
+        async with session.ws_connect(f'http://127.0.0.1:{server.port}/ws') as ws:
+            await ws.send_str('register_4.1.0 user')
+            msg = await ws.receive(timeout=5)
+            assert msg.data == Responses.SERVER_ERROR
+            msg = await ws.receive(timeout=5)
+            assert msg.type == aiohttp.WSMsgType.CLOSE
+            assert msg.data == aiohttp.WSCloseCode.INTERNAL_ERROR
+        assert not server.session_manager.sessions
+
+
+@asynccontextmanager
+async def registered(server: WebServer, version: str) -> AsyncIterator[aiohttp.ClientWebSocketResponse]:
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(f'http://127.0.0.1:{server.port}/ws') as ws:
+            await ws.send_str(f'register_{version} user')
+            yield ws
+
+
+async def test_continue_n_sends_batch(tmp_path):
+    async with running_server(tmp_path, max_prefetch=3) as server:
+        await server.put_passcodes([f'code{num}' for num in range(6)])
+        async with registered(server, WebServer.prefetch_version) as ws:
+            assert (await ws.receive_json(timeout=5))['body'] == 'code0'
+            await ws.send_str('continue 2')
+            assert await ws.receive_json(timeout=5) == {'status': 200, 'sub': 1, 'body': ['code1', 'code2']}
+            # Capped by max_prefetch
+            await ws.send_str('continue 10')
+            assert (await ws.receive_json(timeout=5))['body'] == ['code3', 'code4', 'code5']
+
+
+@pytest.mark.parametrize('command', ['continue 0', 'continue -1', 'continue two'])
+async def test_bad_continue(tmp_path, command):
+    async with running_server(tmp_path) as server:
+        await server.put_passcodes(['code0', 'code1'])
+        async with registered(server, WebServer.prefetch_version) as ws:
+            assert (await ws.receive_json(timeout=5))['body'] == 'code0'
+            await ws.send_str(command)
+            assert (await ws.receive(timeout=5)).data == Responses.BAD_CONTINUE
+
+
+@pytest.mark.parametrize('command', ['continue 2', 'FR code0', 'mark_other code0'])
+async def test_prefetch_commands_need_new_script(tmp_path, command):
+    async with running_server(tmp_path) as server:
+        await server.put_passcodes(['code0', 'code1'])
+        async with registered(server, WebServer.minimum_version) as ws:
+            assert (await ws.receive_json(timeout=5))['body'] == 'code0'
+            await ws.send_str(command)
+            assert (await ws.receive(timeout=5)).data == Responses.FORBIDDEN
+
+
+@pytest.mark.parametrize('command, marks', [('FR', (1, 0)), ('mark_other', (0, 1))])
+async def test_mark_code_of_last_batch(tmp_path, command, marks):
+    async with running_server(tmp_path) as server:
+        await server.put_passcodes(['code0', 'code1', 'code2'])
+        async with registered(server, WebServer.prefetch_version) as ws:
+            assert (await ws.receive_json(timeout=5))['body'] == 'code0'
+            await ws.send_str('continue 2')
+            assert (await ws.receive_json(timeout=5))['body'] == ['code1', 'code2']
+            # code0 was sent in an earlier batch
+            await ws.send_str(f'{command} CODE0')
+            assert (await ws.receive(timeout=5)).data == Responses.CODE_NOT_SENT
+            await ws.send_str(f'{command} CODE1')
+            await ws.send_str(f'{command} unknown')
+            assert (await ws.receive(timeout=5)).data == Responses.CODE_NOT_SENT
+        rows = await server.conn.pool.writer.execute_fetchall('''SELECT "code", "FR", "other" FROM "storage"''')
+        assert {row[0]: (row[1], row[2]) for row in rows} == {'code0': (0, 0), 'code1': marks, 'code2': (0, 0)}
+
+
+class RecordingWebSocket:
+    """Websocket which writes once `writable` is set, or fails when `broken`"""
+
+    def __init__(self, broken: bool = False):
+        self.frames = []
+        self.closed_with = None
+        self.broken = broken
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def _write(self, frame) -> None:
+        await self.writable.wait()
+        if self.broken:
+            raise ConnectionResetError
+        self.frames.append(frame)
+
+    async def send_str(self, frame: str) -> None:
+        await self._write(frame)
+
+    async def send_bytes(self, frame: bytes) -> None:
+        await self._write(frame)
+
+    async def close(self, **kwargs) -> None:
+        self.closed_with = kwargs
+
+
+def frames_of(queue: OutboundQueue):
+    return [frame for _, frame, _ in queue.frames]
+
+
+async def test_outbound_drop_oldest():
+    drops = []
+    limiter = OutboundLimiter()
+    queue = OutboundQueue(RecordingWebSocket(), 2, 'drop-oldest', limiter, on_drop=drops.append)
+    for frame in ('a', 'b', 'c'):
+        assert queue.put(frame, 'code')
+    assert frames_of(queue) == ['b', 'c']
+    assert (queue.dropped, limiter.pending, drops) == (1, 2, ['drop-oldest'])
+
+
+async def test_outbound_coalesce():
+    limiter = OutboundLimiter()
+    queue = OutboundQueue(RecordingWebSocket(), 2, 'coalesce', limiter)
+    queue.put('code1', 'code')
+    queue.put('status1', 'status')
+    # Replaces the waiting frame of the same key
+    queue.put('code2', 'code')
+    assert frames_of(queue) == ['status1', 'code2']
+    # Oldest goes when no frame has the key
+    queue.put('other', 'other')
+    assert frames_of(queue) == ['code2', 'other']
+    assert (queue.dropped, limiter.pending) == (2, 2)
+
+
+async def test_outbound_disconnect():
+    ws = RecordingWebSocket()
+    limiter = OutboundLimiter()
+    queue = OutboundQueue(ws, 2, 'disconnect', limiter)
+    assert queue.put('a') and queue.put('b')
+    assert not queue.put('c')
+    assert queue.closed and not queue.put('d')
+    await asyncio.sleep(0)
+    assert ws.closed_with['code'] == aiohttp.WSCloseCode.TRY_AGAIN_LATER
+    await queue.close()
+    assert (len(queue), limiter.pending) == (0, 0)
+
+
+async def test_outbound_global_limit():
+    limiter = OutboundLimiter(3)
+    slow, idle = (OutboundQueue(RecordingWebSocket(), 10, 'drop-oldest', limiter) for _ in range(2))
+    for frame in ('a', 'b', 'c'):
+        slow.put(frame)
+    assert limiter.full
+    # Only sessions with a backlog give way
+    assert idle.put('x') and limiter.pending == 4
+    slow.put('d')
+    assert frames_of(slow) == ['b', 'c', 'd'] and limiter.pending == 4
+
+
+async def test_outbound_writer_accounting():
+    ws = RecordingWebSocket()
+    ws.writable.clear()
+    limiter = OutboundLimiter()
+    queue = OutboundQueue(ws, 4, 'drop-oldest', limiter)
+    queue.start()
+    queue.put('a')
+    queue.put(b'b')
+    await asyncio.sleep(0)
+    # First frame is taken by the writer
+    assert (len(queue), limiter.pending) == (1, 1)
+    ws.writable.set()
+    await queue.drain(1)
+    assert ws.frames == ['a', b'b']
+    assert (queue.sent, limiter.pending) == (2, 0)
+    await queue.close()
+
+
+async def test_outbound_write_failure_releases_pending():
+    ws = RecordingWebSocket(broken=True)
+    limiter = OutboundLimiter()
+    queue = OutboundQueue(ws, 4, 'drop-oldest', limiter)
+    for frame in ('a', 'b', 'c'):
+        queue.put(frame)
+    queue.start()
+    await queue.drain(1)
+    assert queue.closed and not queue.put('d')
+    assert (len(queue), limiter.pending, queue.sent) == (0, 0, 0)
+    await queue.close()
+    assert limiter.pending == 0
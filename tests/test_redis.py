@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# test_redis.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from libredis import RedisCodeStorage  # noqa: E402
+
+
+def new_storage() -> RedisCodeStorage:
+    return RedisCodeStorage(fakeredis.FakeAsyncRedis(decode_responses=True), 'test')
+
+
+async def test_insert_dedupe():
+    conn = new_storage()
+    assert await conn.insert_code('AAA')
+    assert not await conn.insert_code('aaa')
+    result = await conn.insert_codes(['bbb', 'aaa', 'ccc', 'BBB', 'ddd'], chunk_size=2)
+    assert result.inserted == ['bbb', 'ccc', 'ddd']
+    assert result.duplicated == ['aaa', 'bbb']
+    assert await conn.latest_code_id() == 4
+    assert await conn.fetch_recent_codes(2) == ['ccc', 'ddd']
+
+
+async def test_assign_in_order():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb', 'ccc', 'ddd'])
+    assert await conn.request_next_code('alice') == 'aaa'
+    assert await conn.request_next_codes('alice', 2) == ['bbb', 'ccc']
+    assert await conn.request_next_code('bob') == 'aaa'
+    assert await conn.request_next_codes('alice', 5) == ['ddd']
+    assert await conn.request_next_code('alice') is None
+    await conn.insert_code('eee')
+    assert await conn.request_next_code('alice') == 'eee'
+
+
+async def test_mark_removes_from_live():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb', 'ccc'])
+    await conn.mark_code('AAA', True)
+    await conn.mark_codes([('bbb', False, True)])
+    assert await conn.redis.zrange(conn.key_live, 0, -1) == ['ccc']
+    assert await conn.redis.hgetall(conn.key_marks) == {'aaa': '10', 'bbb': '01'}
+    assert await conn.request_next_code('alice') == 'ccc'
+    # Unmarked code goes back to its place
+    await conn.mark_code('aaa', False, False)
+    assert await conn.redis.zrange(conn.key_live, 0, -1) == ['aaa', 'ccc']
+    assert await conn.request_next_code('bob') == 'aaa'
+    # Unknown code is ignored
+    await conn.mark_code('zzz', True)
+    assert 'zzz' not in await conn.redis.hkeys(conn.key_marks)
+
+
+async def test_assign_code_only_moves_cursor_forward():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb', 'ccc', 'ddd'])
+    await conn.assign_code('CCC', ['alice', 'bob'])
+    assert await conn.request_next_code('alice') == 'ddd'
+    await conn.assign_code('aaa', ['alice', 'bob'])
+    assert await conn.redis.hgetall(conn.key_cursors) == {'alice': '4', 'bob': '3'}
+    assert await conn.request_next_code('bob') == 'ddd'
+    # Unknown code does not touch cursors
+    await conn.assign_code('zzz', ['carol'])
+    assert await conn.request_next_code('carol') == 'aaa'
+
+
+async def test_delete_code():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb'])
+    await conn.mark_code('aaa', True)
+    await conn.delete_code('AAA')
+    await conn.delete_code('bbb')
+    assert await conn.redis.zcard(conn.key_all) == 0
+    assert await conn.redis.zcard(conn.key_live) == 0
+    assert await conn.redis.hlen(conn.key_marks) == 0
+    assert await conn.request_next_code('alice') is None
+    # Deleted code can be inserted again
+    assert await conn.insert_code('aaa')
+    assert await conn.request_next_code('alice') == 'aaa'
+
+
+async def test_lease_held_by_one_user():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb'])
+    assert await conn.lease_next_code('alice', 60) == 'aaa'
+    assert await conn.lease_next_code('bob', 60) == 'bbb'
+    assert await conn.lease_next_code('carol', 60) is None
+    # Lease of another user is not dropped
+    await conn.release_lease('bob', 'aaa')
+    assert await conn.lease_next_code('carol', 60) is None
+    await conn.release_lease('alice', 'AAA')
+    assert await conn.lease_next_code('carol', 60) == 'aaa'
+
+
+async def test_lease_expired_is_taken_over():
+    conn = new_storage()
+    await conn.insert_code('aaa')
+    assert await conn.lease_next_code('alice', -1) == 'aaa'
+    assert await conn.lease_next_code('bob', 60) == 'aaa'
+    assert await conn.redis.hget(conn.key_owners, 'aaa') == 'bob'
+
+
+async def test_complete_lease_passes_code_on():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb'])
+    assert await conn.lease_next_code('alice', 60) == 'aaa'
+    await conn.complete_lease('alice', 'aaa')
+    assert await conn.lease_next_code('alice', 60) == 'bbb'
+    await conn.complete_lease('alice', 'bbb')
+    assert await conn.lease_next_code('alice', 60) is None
+    assert await conn.lease_next_code('bob', 60) == 'aaa'
+    assert await conn.redis.zcard(conn.key_leases) == 1
+
+
+async def test_lease_skips_marked_and_scans_batches():
+    conn = new_storage()
+    await conn.insert_codes([f'code{num:03d}' for num in range(10)])
+    for num in range(7):
+        await conn.complete_lease('alice', f'code{num:03d}')
+    await conn.mark_code('code007', True)
+    assert await conn.lease_next_code('alice', 60, batch=3) == 'code008'
+
+
+async def test_lease_of_reinserted_code():
+    conn = new_storage()
+    await conn.insert_code('aaa')
+    assert await conn.lease_next_code('alice', 60) == 'aaa'
+    await conn.complete_lease('alice', 'aaa')
+    await conn.delete_code('aaa')
+    assert await conn.redis.zcard(conn.key_leases) == 0
+    # Tried codes are kept by id, so a new code with same text is handed out again
+    await conn.insert_code('aaa')
+    assert await conn.lease_next_code('alice', 60) == 'aaa'
+
+
+async def test_lease_shared_by_servers():
+    server = fakeredis.FakeServer()
+    first, second = (RedisCodeStorage(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), 'test')
+                     for _ in range(2))
+    await first.insert_codes(['aaa', 'bbb'])
+    assert await first.lease_next_code('alice', 60) == 'aaa'
+    assert await second.lease_next_code('bob', 60) == 'bbb'
+    await first.release_lease('alice', 'aaa')
+    assert await second.lease_next_code('carol', 60) == 'aaa'
+
+
+async def test_compact_drops_dead_codes():
+    conn = new_storage()
+    await conn.insert_codes([f'code{num}' for num in range(6)])
+    assert await conn.lease_next_code('alice', 60) == 'code0'
+    await conn.complete_lease('alice', 'code0')
+    assert await conn.lease_next_code('alice', 60) == 'code1'
+    await conn.mark_code('code1', True)
+    await conn.mark_code('code4', False, True)
+    await conn.mark_code('code5', True)
+    await conn.mark_code('code5', False, False)
+    # Scan is cut in steps of 2 codes, steps without dead code are skipped over
+    assert await conn.compact_step(step=2) == ['code1']
+    assert await conn.compact_step(step=2) == ['code4']
+    assert await conn.compact_step(step=2) == []
+    for key in (conn.key_all, conn.key_live, conn.key_created):
+        assert set(await conn.redis.zrange(key, 0, -1)) == {'code0', 'code2', 'code3', 'code5'}
+    assert await conn.redis.hkeys(conn.key_marks) == ['code5']
+    assert await conn.redis.zcard(conn.key_leases) == 0
+    assert await conn.redis.hlen(conn.key_owners) == 0
+    assert await conn.redis.smembers(conn.key_tried + 'alice') == {'1'}
+    assert await conn.request_next_codes('bob', 5) == ['code0', 'code2', 'code3', 'code5']
+    # Dropped code is forgotten
+    assert await conn.insert_code('code1')
+
+
+async def test_compact_drops_expired_codes():
+    conn = new_storage()
+    await conn.insert_codes(['code0', 'code1'])
+    await conn.redis.zadd(conn.key_created, {'code0': 1})
+    assert await conn.request_next_code('alice') == 'code0'
+    await conn.complete_lease('alice', 'code0')
+    assert await conn.compact_step() == []
+    assert await conn.compact_step(ttl=60) == ['code0']
+    assert await conn.redis.zrange(conn.key_all, 0, -1) == ['code1']
+    assert await conn.redis.scard(conn.key_tried + 'alice') == 0
+    # Cursor stays valid as ids are never reused
+    assert await conn.request_next_code('alice') == 'code1'
+
+
+async def test_lease_scan_is_capped():
+    conn = new_storage()
+    await conn.insert_codes([f'code{num:02d}' for num in range(12)])
+    for num in range(10):
+        await conn.complete_lease('alice', f'code{num:02d}')
+    # Floor moves over tried codes, so each call goes further
+    assert await conn.lease_next_code('alice', 60, batch=3, limit=5) is None
+    assert await conn.redis.hget(conn.key_floors, 'alice') == '5'
+    assert await conn.lease_next_code('alice', 60, batch=3, limit=5) is None
+    assert await conn.redis.hget(conn.key_floors, 'alice') == '10'
+    assert await conn.lease_next_code('alice', 60, batch=3, limit=5) == 'code10'
+
+
+async def test_lease_floor_stops_at_code_not_tried():
+    conn = new_storage()
+    await conn.insert_codes(['aaa', 'bbb', 'ccc'])
+    await conn.complete_lease('alice', 'aaa')
+    assert await conn.lease_next_code('bob', 60) == 'aaa'
+    assert await conn.lease_next_code('bob', 60) == 'bbb'
+    assert await conn.lease_next_code('alice', 60) == 'ccc'
+    assert await conn.redis.hget(conn.key_floors, 'alice') == '1'
+    await conn.release_lease('bob', 'bbb')
+    assert await conn.lease_next_code('alice', 60) == 'bbb'
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# test_snapshot.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import time
+
+from libsnapshot import Snapshot
+from libsqlite import CodeStorage, MemoryCodeStorage
+from localserver import WebServer
+
+
+def memory_state(conn: MemoryCodeStorage):
+    return list(conn.live_ids), dict(conn.codes), dict(conn.ids), dict(conn.cursors)
+
+
+async def prepare(file_name: str, snapshot_file: str) -> None:
+    conn = await MemoryCodeStorage.new(file_name)
+    await conn.insert_codes([f'code{num}' for num in range(5)])
+    await conn.mark_code('code1', True)
+    assert await conn.request_next_codes('alice', 2) == ['code0', 'code2']
+    assert await conn.request_next_code('bob') == 'code0'
+    (await Snapshot.take(conn, ['code3', 'code4'])).dump(snapshot_file)
+    await conn.close()
+
+
+async def open_restored(file_name: str, snapshot: Snapshot, monkeypatch) -> MemoryCodeStorage:
+    async def no_load(_self):
+        raise AssertionError('Storage is loaded from database')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(MemoryCodeStorage, 'load', no_load)
+        return await MemoryCodeStorage.new(file_name, state=(snapshot.fingerprint, snapshot.storage))
+
+
+async def test_restore_matches_full_load(tmp_path, monkeypatch):
+    file_name, snapshot_file = os.path.join(tmp_path, 'test.db'), os.path.join(tmp_path, 'test.snapshot')
+    await prepare(file_name, snapshot_file)
+    snapshot = Snapshot.load(snapshot_file)
+    assert snapshot.dedupe == ['code3', 'code4']
+    restored = await open_restored(file_name, snapshot, monkeypatch)
+    try:
+        assert await snapshot.matches(restored)
+        state = memory_state(restored)
+    finally:
+        await restored.close()
+    loaded = await MemoryCodeStorage.new(file_name)
+    try:
+        assert memory_state(loaded) == state
+        assert state[0] == [1, 3, 4, 5] and state[3] == {'alice': 3, 'bob': 1}
+        assert await loaded.request_next_code('alice') == 'code3'
+    finally:
+        await loaded.close()
+
+
+async def test_stale_snapshot_falls_back_to_load(tmp_path):
+    file_name, snapshot_file = os.path.join(tmp_path, 'test.db'), os.path.join(tmp_path, 'test.snapshot')
+    await prepare(file_name, snapshot_file)
+    # Database changed after the snapshot was taken
+    conn = await CodeStorage.new(file_name)
+    await conn.insert_code('code5')
+    await conn.close()
+    snapshot = Snapshot.load(snapshot_file)
+    conn = await MemoryCodeStorage.new(file_name, state=(snapshot.fingerprint, snapshot.storage))
+    try:
+        assert not await snapshot.matches(conn)
+        assert conn.ids['code5'] == 6 and conn.live_ids[-1] == 6
+        assert conn.memory_fingerprint() == await conn.fingerprint()
+    finally:
+        await conn.close()
+
+
+async def test_snapshot_max_age(tmp_path):
+    snapshot_file = os.path.join(tmp_path, 'test.snapshot')
+    Snapshot([1], ['code0'], written_at=time.time() - 120).dump(snapshot_file)
+    assert Snapshot.load(snapshot_file, max_age=60) is None
+    assert Snapshot.load(snapshot_file).dedupe == ['code0']
+    with open(snapshot_file) as fin:
+        data = json.load(fin)
+    data['version'] = Snapshot.version + 1
+    with open(snapshot_file, 'w') as fout:
+        json.dump(data, fout)
+    assert Snapshot.load(snapshot_file) is None
+    with open(snapshot_file, 'w') as fout:
+        fout.write('{')
+    assert Snapshot.load(snapshot_file) is None
+    assert Snapshot.load(os.path.join(tmp_path, 'missing.snapshot')) is None
+
+
+async def test_web_server_dedupe_from_snapshot(tmp_path):
+    conn = await CodeStorage.new(os.path.join(tmp_path, 'test.db'))
+    try:
+        await conn.insert_codes(['code0', 'code1'])
+        snapshot = await Snapshot.take(conn, ['code1', 'other'])
+        server = await WebServer.new('ws', '127.0.0.1', 0, conn, snapshot=snapshot)
+        assert server.dedupe.codes() == ['code1', 'other']
+        # Storage changed, dedupe index is warmed from storage instead
+        await conn.insert_code('code2')
+        server = await WebServer.new('ws', '127.0.0.1', 0, conn, snapshot=snapshot)
+        assert server.dedupe.codes() == ['code0', 'code1', 'code2']
+    finally:
+        await conn.close()
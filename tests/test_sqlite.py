@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# test_sqlite.py
+# Copyright (C) 2020-2022 KunoiSayami
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import os
+
+import pytest
+
+from libsqlite import CodeStorage, MarkBuffer, MemoryCodeStorage
+from localserver import WebServer
+
+
+async def test_mark_buffer_dead_while_flushing():
+    release = asyncio.Event()
+    written = []
+
+    async def writer(marks):
+        await release.wait()
+        written.extend(marks)
+
+    buffer = MarkBuffer(writer)
+    buffer.mark('ABC', True, False)
+    flush = asyncio.create_task(buffer.flush())
+    await asyncio.sleep(0)
+    assert not buffer.pending
+    assert buffer.is_dead('abc')
+    # Newer mark overrides the one being written
+    buffer.mark('abc', False, False)
+    assert not buffer.is_dead('abc')
+    release.set()
+    await flush
+    assert written == [('abc', 1, 0)]
+    assert not buffer.inflight
+
+
+async def test_mark_buffer_keeps_marks_of_failed_flush():
+    async def writer(_marks):
+        raise RuntimeError
+
+    buffer = MarkBuffer(writer)
+    buffer.mark('abc', False, True)
+    await buffer.flush()
+    assert buffer.pending == {'abc': (0, 1)}
+    assert not buffer.inflight
+    assert buffer.is_dead('abc')
+
+
+async def test_write_behind_skips_marked_codes(tmp_path):
+    conn = await CodeStorage.new(os.path.join(tmp_path, 'test.db'), write_behind=True, write_behind_interval=60)
+    try:
+        await conn.insert_codes(['code1', 'code2'])
+        await conn.mark_code('code1', True)
+        assert await conn.request_next_code('user') == 'code2'
+        await conn.mark_buffer.flush()
+        assert await conn.request_next_code('other') == 'code2'
+    finally:
+        await conn.close()
+
+
+def slow_writer(writer, started: asyncio.Event):
+    async def wrapper(items):
+        started.set()
+        await asyncio.sleep(.2)
+        await writer(items)
+    return wrapper
+
+
+async def test_mark_buffer_keeps_marks_of_cancelled_flush():
+    async def writer(_marks):
+        await asyncio.sleep(60)
+
+    buffer = MarkBuffer(writer)
+    buffer.mark('abc', True, False)
+    flush = asyncio.create_task(buffer.flush())
+    await asyncio.sleep(0)
+    flush.cancel()
+    await asyncio.gather(flush, return_exceptions=True)
+    assert buffer.pending == {'abc': (1, 0)}
+    assert not buffer.inflight
+
+
+async def test_close_waits_for_running_flush(tmp_path):
+    file_name = os.path.join(tmp_path, 'test.db')
+    conn = await CodeStorage.new(file_name, write_behind=True, write_behind_size=1)
+    await conn.insert_codes(['code1', 'code2'])
+    started = asyncio.Event()
+    conn.mark_buffer.writer = slow_writer(conn.mark_buffer.writer, started)
+    await conn.mark_code('code1', True)
+    await started.wait()
+    await conn.mark_code('code2', False, True)
+    await conn.close()
+    conn = await CodeStorage.new(file_name)
+    try:
+        rows = await conn.pool.writer.execute_fetchall('''SELECT "code", "FR", "other" FROM "storage" ORDER BY "id"''')
+        assert [tuple(row) for row in rows] == [('code1', 1, 0), ('code2', 0, 1)]
+    finally:
+        await conn.close()
+
+
+async def test_memory_close_waits_for_running_cursor_flush(tmp_path):
+    file_name = os.path.join(tmp_path, 'test.db')
+    conn = await MemoryCodeStorage.new(file_name)
+    await conn.insert_codes(['code1', 'code2'])
+    started = asyncio.Event()
+    conn.cursor_buffer.max_size = 1
+    conn.cursor_buffer.writer = slow_writer(conn.cursor_buffer.writer, started)
+    assert await conn.request_next_code('user') == 'code1'
+    await started.wait()
+    await conn.close()
+    conn = await MemoryCodeStorage.new(file_name)
+    try:
+        assert await conn.request_next_code('user') == 'code2'
+    finally:
+        await conn.close()
+
+
+@pytest.mark.parametrize('storage_cls', [CodeStorage, MemoryCodeStorage])
+async def test_compact_archives_dead_codes(tmp_path, storage_cls):
+    conn = await storage_cls.new(os.path.join(tmp_path, 'test.db'))
+    try:
+        await conn.insert_codes([f'code{num}' for num in range(6)])
+        assert await conn.request_next_codes('alice', 3) == ['code0', 'code1', 'code2']
+        assert await conn.lease_next_code('bob', 60) == 'code0'
+        await conn.complete_lease('bob', 'code0')
+        assert await conn.lease_next_code('bob', 60) == 'code1'
+        await conn.mark_code('code0', True)
+        await conn.mark_code('code1', False, True)
+        await conn.pool.writer.execute_fetchall('''UPDATE "storage" SET "created_at" = 1 WHERE "code" = 'code3' ''')
+        assert await conn.compact_step(step=1) == ['code0']
+        assert await conn.compact_step(step=1) == ['code1']
+        assert await conn.compact_step(step=1) == []
+        # Expired codes go only when ttl is given
+        assert await conn.compact_step(ttl=60) == ['code3']
+        assert await conn.compact_step(ttl=60) == []
+        db = conn.pool.writer
+        rows = await db.execute_fetchall('''SELECT "code", "FR", "other" FROM "storage_archive" ORDER BY "id"''')
+        assert [tuple(row) for row in rows] == [('code0', 1, 0), ('code1', 0, 1), ('code3', 0, 0)]
+        rows = await db.execute_fetchall('''SELECT "code" FROM "storage" ORDER BY "id"''')
+        assert [row[0] for row in rows] == ['code2', 'code4', 'code5']
+        for table in ('code_lease', 'code_attempt'):
+            assert (await db.execute_fetchall(f'''SELECT COUNT(*) FROM "{table}"'''))[0][0] == 0
+        # Archived codes are still duplicated
+        assert not await conn.insert_code('CODE0')
+        result = await conn.insert_codes(['code1', 'code6'])
+        assert result.inserted == ['code6'] and result.duplicated == ['code1']
+        # Cursors stay valid, ids are never reused
+        assert await conn.request_next_codes('alice', 5) == ['code4', 'code5', 'code6']
+        assert await conn.request_next_codes('carol', 5) == ['code2', 'code4', 'code5', 'code6']
+        if storage_cls is MemoryCodeStorage:
+            await conn.flush()
+            assert conn.memory_fingerprint() == await conn.fingerprint()
+            assert sorted(conn.ids) == ['code2', 'code4', 'code5', 'code6']
+    finally:
+        await conn.close()
+
+
+async def test_web_server_compact_prunes_dedupe(tmp_path):
+    conn = await CodeStorage.new(os.path.join(tmp_path, 'test.db'))
+    server = WebServer('ws', '127.0.0.1', 0, conn, compact_step=1)
+    try:
+        await server.put_passcodes(['code0', 'code1', 'code2'])
+        await conn.mark_code('code0', True)
+        await conn.mark_code('code2', True)
+        assert await server.compact() == 2
+        assert 'code0' not in server.dedupe and 'code2' not in server.dedupe
+        assert 'code1' in server.dedupe
+        # Dedupe index forgets it, storage still rejects it
+        assert (await server.put_passcodes(['code0'])).duplicated == ['code0']
+    finally:
+        await conn.close()